@@ -1,29 +1,122 @@
-from env import host, user, password
 import pandas as pd
 import numpy as np
 import os
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy
+
+from instrument import instrumented
+
+# columnar cache that replaces the old zillow_df.csv
+zillow_cache_file = 'zillow_df.parquet'
+zillow_csv_file = 'zillow_df.csv'
+# per row fingerprints of the cached predictions_2017 rows, used for incremental refreshes
+zillow_fingerprint_file = 'zillow_fingerprints.parquet'
 
 
 ################################### Get Connection to SQL Function ###################################
 
-def get_connection(db, user = user, host = host, password = password):
+def get_connection(db, user = None, host = None, password = None):
     '''
     This function uses my info from my env file to
     create a connection url to access the Codeup db.
+    env is only imported here, so everything that works from the cache
+    runs without database credentials.
     '''
+    import env
+    user = env.user if user is None else user
+    host = env.host if host is None else host
+    password = env.password if password is None else password
     return f'mysql+pymysql://{user}:{password}@{host}/{db}'
-    
 
-###################################  Acquire New Zillow Data Function ###################################
 
+################################### Pooled Engine Functions ###################################
 
-def new_zillow_data():
+# one pooled engine per database name, created the first time it is asked for
+engine_registry = {}
+engine_lock = threading.Lock()
+# per database connection checkout counts and latency
+connection_metrics = {}
+
+
+def get_engine(db, url = None, pool_size = 5, max_overflow = 10, pool_pre_ping = True, pool_recycle = 3600):
     '''
-    This function reads the zillow data from CodeUp database into a df,
-    write it to a csv file, and returns the df.
+    This function returns the pooled engine for db, creating it on first use.
+    The pool settings (and url, which defaults to get_connection(db))
+    only apply when the engine is created, pass url to point a db name
+    at a stand-in database such as 'sqlite:///zillow.db'.
+    '''
+    with engine_lock:
+        if db not in engine_registry:
+            engine_registry[db] = sqlalchemy.create_engine(url or get_connection(db),
+                                                           poolclass = sqlalchemy.pool.QueuePool,
+                                                           pool_size = pool_size,
+                                                           max_overflow = max_overflow,
+                                                           pool_pre_ping = pool_pre_ping,
+                                                           pool_recycle = pool_recycle)
+            connection_metrics[db] = {'connects': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+        return engine_registry[db]
+
+
+@contextmanager
+def connect(db):
+    '''
+    This function checks a connection for db out of its pooled engine,
+    recording how long the checkout took, and returns it to the pool afterwards
+    '''
+    engine = get_engine(db)
+    start = time.perf_counter()
+    conn = engine.connect()
+    elapsed = time.perf_counter() - start
+    with engine_lock:
+        metrics = connection_metrics[db]
+        metrics['connects'] += 1
+        metrics['total_seconds'] += elapsed
+        metrics['max_seconds'] = max(metrics['max_seconds'], elapsed)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def connection_stats():
+    '''
+    This function returns a df with one row per pooled engine:
+    the number of checkouts, mean and max checkout latency in milliseconds,
+    the pool size and how many connections are checked out right now
     '''
-    sql_query = '''
-                select * 
+    with engine_lock:
+        rows = {db: {'connects': metrics['connects'],
+                     'mean_ms': 1000 * metrics['total_seconds'] / max(metrics['connects'], 1),
+                     'max_ms': 1000 * metrics['max_seconds'],
+                     'pool_size': engine_registry[db].pool.size(),
+                     'checked_out': engine_registry[db].pool.checkedout()}
+                for db, metrics in connection_metrics.items()}
+    return pd.DataFrame.from_dict(rows, orient = 'index')
+
+
+def dispose_engines():
+    '''
+    This function closes every pooled connection and empties the engine registry
+    '''
+    with engine_lock:
+        for engine in engine_registry.values():
+            engine.dispose()
+        engine_registry.clear()
+        connection_metrics.clear()
+
+
+###################################  Acquire New Zillow Data Function ###################################
+
+
+# the nine-way join of 2017 single unit properties, {columns} is filled in with '*' or a column list
+zillow_query = '''
+                select {columns}
                 from properties_2017
                 join predictions_2017 using (parcelid)
                 left join airconditioningtype using (airconditioningtypeid)
@@ -36,35 +129,518 @@ def new_zillow_data():
                 left join unique_properties using (parcelid)
                 where latitude is not null 
                 and longitude is not null
-                and propertylandusetypeid = 261;
+                and propertylandusetypeid = 261
                 '''
-    df = pd.read_sql(sql_query, get_connection('zillow'))
-    df.to_csv('zillow_df.csv')
+
+#every raw column wrangle_zillow reads, keeps or drops, in the order the join returns them
+zillow_columns = ['id', 'parcelid', 'bathroomcnt', 'bedroomcnt', 'buildingqualitytypeid', 'calculatedbathnbr',
+                  'calculatedfinishedsquarefeet', 'finishedsquarefeet12', 'fips', 'fireplacecnt', 'fullbathcnt',
+                  'heatingorsystemtypeid', 'latitude', 'longitude', 'lotsizesquarefeet', 'poolcnt',
+                  'propertycountylandusecode', 'propertylandusetypeid', 'propertyzoningdesc',
+                  'rawcensustractandblock', 'regionidcity', 'regionidcounty', 'regionidzip', 'roomcnt',
+                  'unitcnt', 'yearbuilt', 'structuretaxvaluedollarcnt', 'taxvaluedollarcnt', 'assessmentyear',
+                  'landtaxvaluedollarcnt', 'taxamount', 'censustractandblock',
+                  'id.1', 'logerror', 'transactiondate', 'heatingorsystemdesc', 'propertylandusedesc']
+
+
+def zillow_select(columns=None):
+    '''
+    This function builds the select list for zillow_query,
+    'id' is the properties_2017 id and 'id.1' the predictions_2017 id
+    '''
+    if columns is None:
+        return '*'
+    select = []
+    for col in columns:
+        if col == 'id':
+            select.append('properties_2017.id')
+        elif col == 'id.1':
+            select.append('predictions_2017.id as `id.1`')
+        else:
+            select.append(col)
+    return ', '.join(select)
+
+
+def new_zillow_data():
+    '''
+    This function reads the zillow data from CodeUp database into a df,
+    writes it to the parquet cache, and returns the df.
+    '''
+    sql_query = zillow_query.format(columns = '*')
+    with connect('zillow') as conn:
+        df = pd.read_sql(sqlalchemy.text(sql_query), conn)
+    df = write_zillow_cache(df)
     return df
 
 
-###################################  Get Zillow Data Function ###################################
+def stream_zillow_data(chunksize=10000, columns=zillow_columns, filename=zillow_cache_file,
+                       fingerprint_filename=zillow_fingerprint_file):
+    '''
+    This function pulls the zillow join through a server side cursor
+    chunksize rows at a time, only selecting the given columns (None for all),
+    and writes the chunks to the parquet cache with write_chunked_cache,
+    returns the number of rows written.
+    '''
+    sql_query = zillow_query.format(columns = zillow_select(columns))
+    def chunks():
+        with connect('zillow') as conn:
+            #stream_results makes pymysql use an unbuffered SSCursor
+            conn = conn.execution_options(stream_results=True)
+            yield from pd.read_sql(sqlalchemy.text(sql_query), conn, chunksize=chunksize)
+    return write_chunked_cache(chunks(), filename, fingerprint_filename)
 
 
-def get_zillow_data(cached=False):
+def write_chunked_cache(chunks, filename=zillow_cache_file, fingerprint_filename=zillow_fingerprint_file):
     '''
-    This function reads in zillow data from CodeUp database if cached == False 
-    or if cached == True reads in mall customers df from a csv file, returns df.
+    This function writes any iterable of zillow dfs to the parquet cache
+    with memory bounded by one chunk. Each chunk is written straight to disk,
+    then a second pass over the chunk files casts every chunk to one set of dtypes
+    and writes the parquet cache, returns the number of rows written.
+    A query with no rows still gives one empty chunk and an empty cache,
+    no chunks at all raises a ValueError and leaves any existing cache as it was.
     '''
-    if cached or os.path.isfile('zillow_df.csv') == False:
-        df = new_zillow_data()
+    chunk_dir = filename + '.chunks'
+    os.makedirs(chunk_dir, exist_ok=True)
+    stats = {}
+    chunk_files = []
+    fingerprints = []
+    rows = 0
+    for chunk in chunks:
+        chunk = dedupe_columns(chunk)
+        #chunks may each start at 0, keep one index for the whole table
+        chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+        rows += len(chunk)
+        dtype_stats(chunk, stats)
+        if has_predictions(chunk):
+            fingerprints.append(prediction_fingerprints(chunk))
+        chunk_file = os.path.join(chunk_dir, f'{len(chunk_files)}.parquet')
+        chunk.to_parquet(chunk_file)
+        chunk_files.append(chunk_file)
+    if not chunk_files:
+        os.rmdir(chunk_dir)
+        #without a chunk there are no columns to build the cache's schema from
+        raise ValueError(f'no chunks were given, {filename} was not written')
+    schema = arrow_schema(stats)
+    dtypes = plan_dtypes(stats)
+    writer = None
+    for chunk_file in chunk_files:
+        chunk = pd.read_parquet(chunk_file)
+        chunk = chunk.astype(dtypes)
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=True)
+        if writer is None:
+            #the first table carries the pandas metadata read_parquet needs for the index
+            writer = pq.ParquetWriter(filename, table.schema, compression='zstd')
+        writer.write_table(table)
+        os.remove(chunk_file)
+    writer.close()
+    os.rmdir(chunk_dir)
+    if fingerprints:
+        pd.concat(fingerprints, ignore_index=True).to_parquet(fingerprint_filename)
+    return rows
+
+
+###################################  Client Side Join Functions ###################################
+
+
+# the lookup tables zillow_query left joins, with the id column each one is joined on
+zillow_dimensions = {'airconditioningtype': 'airconditioningtypeid',
+                     'architecturalstyletype': 'architecturalstyletypeid',
+                     'buildingclasstype': 'buildingclasstypeid',
+                     'heatingorsystemtype': 'heatingorsystemtypeid',
+                     'propertylandusetype': 'propertylandusetypeid',
+                     'storytype': 'storytypeid',
+                     'typeconstructiontype': 'typeconstructiontypeid'}
+# the columns each lookup table adds to the join besides its id
+zillow_dimension_columns = {'airconditioningtype': ['airconditioningdesc'],
+                            'architecturalstyletype': ['architecturalstyledesc'],
+                            'buildingclasstype': ['buildingclassdesc'],
+                            'heatingorsystemtype': ['heatingorsystemdesc'],
+                            'propertylandusetype': ['propertylandusedesc'],
+                            'storytype': ['storydesc'],
+                            'typeconstructiontype': ['typeconstructiondesc']}
+# where the lookup tables are cached between runs
+zillow_dimension_dir = 'zillow_dimensions'
+
+# zillow_query without the lookup tables, for one range of parcelids
+zillow_fact_query = '''
+                    select {columns}
+                    from properties_2017
+                    join predictions_2017 using (parcelid)
+                    where latitude is not null
+                    and longitude is not null
+                    and propertylandusetypeid = 261
+                    and parcelid between :low and :high
+                    '''
+
+
+def get_dimension_table(table, ttl=86400, cache_dir=zillow_dimension_dir):
+    '''
+    This function returns a zillow lookup table, reading it from the local cache
+    if it was saved less than ttl seconds ago, otherwise reading it from the database
+    and saving it to the cache
+    '''
+    filename = os.path.join(cache_dir, f'{table}.parquet')
+    if os.path.isfile(filename) and time.time() - os.path.getmtime(filename) < ttl:
+        return pd.read_parquet(filename)
+    with connect('zillow') as conn:
+        df = pd.read_sql(sqlalchemy.text(f'select * from {table}'), conn)
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_parquet(filename)
+    return df
+
+
+def join_dimension(df, dimension, key):
+    '''
+    This function left joins a lookup table onto df in memory,
+    every lookup column is added as a categorical built straight from codes
+    '''
+    lookup = dimension.drop_duplicates(key).set_index(key)
+    #position of each row's id in the lookup table, -1 if it has no match
+    positions = lookup.index.get_indexer(df[key])
+    for col in lookup.columns:
+        categories = pd.Index(lookup[col].dropna().unique())
+        lookup_codes = categories.get_indexer(lookup[col])
+        codes = np.where(positions >= 0, lookup_codes[positions], -1)
+        df[col] = pd.Categorical.from_codes(codes, categories)
+    return df
+
+
+def client_join_zillow_data(columns=None, partitions=4, ttl=86400, chunksize=10000, filename=zillow_cache_file,
+                            fingerprint_filename=zillow_fingerprint_file):
+    '''
+    This function builds the same data as new_zillow_data without joining the lookup tables
+    on the server. The lookup tables (cached locally for ttl seconds) and the fact rows,
+    in partitions parcelid ranges each streamed chunksize rows at a time, are all read
+    at the same time on separate pooled connections, then the lookup columns are joined
+    on in memory. Only the given columns are kept (None for all).
+    Writes the parquet cache and returns the df.
+    '''
+    #the lookup tables that have a column that was asked for, known without reading them
+    wanted = [table for table, lookup_columns in zillow_dimension_columns.items()
+              if columns is None or set(lookup_columns) & set(columns)]
+    #the fact rows also need the id columns of every lookup table being joined
+    if columns is None:
+        fact_columns = 'properties_2017.*, predictions_2017.id as `id.1`, logerror, transactiondate'
     else:
-        df = pd.read_csv('zillow_df.csv', index_col=0)
+        lookup_columns = {c for table in wanted for c in zillow_dimension_columns[table]}
+        fact_columns = [c for c in columns if c not in lookup_columns]
+        fact_columns += [zillow_dimensions[table] for table in wanted
+                         if zillow_dimensions[table] not in fact_columns]
+        fact_columns = zillow_select(fact_columns)
+    sql_query = zillow_fact_query.format(columns = fact_columns)
+
+    def read_partition(low, high):
+        with connect('zillow') as conn:
+            #stream_results reads the partition through a server side cursor
+            conn = conn.execution_options(stream_results=True)
+            return list(pd.read_sql(sqlalchemy.text(sql_query), conn, chunksize=chunksize,
+                                    params={'low': low, 'high': high}))
+
+    with ThreadPoolExecutor(max_workers = len(wanted) + partitions) as pool:
+        tables = {table: pool.submit(get_dimension_table, table, ttl) for table in wanted}
+        #the lookup tables are read while the parcelid range is found
+        with connect('zillow') as conn:
+            low, high = conn.execute(sqlalchemy.text('select min(parcelid), max(parcelid) from properties_2017')).one()
+        bounds = np.linspace(low, high + 1, partitions + 1).astype('int64')
+        parts = [pool.submit(read_partition, int(bounds[i]), int(bounds[i + 1] - 1)) for i in range(partitions)]
+        chunks = [chunk for part in parts for chunk in part.result() if len(chunk)]
+        tables = {table: future.result() for table, future in tables.items()}
+    df = pd.concat(chunks, ignore_index=True)
+    for table in wanted:
+        df = join_dimension(df, tables[table], zillow_dimensions[table])
+    if columns is not None:
+        df = df[columns]
+    return write_zillow_cache(df, filename, fingerprint_filename)
+
+
+###################################  Incremental Refresh Functions ###################################
+
+
+def has_predictions(df):
+    '''
+    This function checks that df has the predictions_2017 columns
+    needed to fingerprint its rows
+    '''
+    return {'parcelid', 'transactiondate', 'logerror'} <= set(df.columns)
+
+
+def prediction_fingerprints(df):
+    '''
+    This function returns the parcelid and transactiondate of every row in df
+    with a hash of the row's predictions_2017 values (parcelid, transactiondate, logerror)
+    so a later refresh can tell which rows are new or have changed
+    '''
+    #normalize dtypes so the cache and a fresh database read hash the same
+    keys = pd.DataFrame({'parcelid': df.parcelid.astype('int64').values,
+                         'transactiondate': pd.to_datetime(df.transactiondate).dt.strftime('%Y-%m-%d').values,
+                         'logerror': df.logerror.astype('float64').values})
+    keys['fingerprint'] = pd.util.hash_pandas_object(keys, index=False).values
+    return keys.drop(columns = 'logerror')
+
+
+def refresh_zillow_cache(check_changed=False, filename=zillow_cache_file,
+                         fingerprint_filename=zillow_fingerprint_file, batch_size=1000):
+    '''
+    This function brings the parquet cache up to date without re-running the whole join.
+    Rows with a transactiondate on or after the high-water mark (the latest cached transactiondate)
+    are fetched and added, so rows that arrive late for that day are not missed.
+    If check_changed == True the narrow predictions_2017 rows before it are
+    also compared against the stored fingerprints and any new or changed rows
+    are fetched batch_size at a time. Cached rows with the same parcelid and transactiondate
+    as a fetched row are replaced. Returns the number of rows fetched.
+    '''
+    stored = pd.read_parquet(fingerprint_filename)
+    #fetch the same columns the cache was built with
+    columns = [c for c in pq.read_schema(filename).names if not c.startswith('__index_level_')]
+    sql_query = zillow_query.format(columns = zillow_select(columns))
+    high_water_mark = stored.transactiondate.max()
+    with connect('zillow') as conn:
+        delta = [pd.read_sql(sqlalchemy.text(sql_query + ' and predictions_2017.transactiondate >= :hwm'),
+                             conn, params={'hwm': high_water_mark})]
+        if check_changed:
+            #only the four predictions columns, filtered the same way as the join,
+            #the high-water mark's own rows were all fetched above
+            narrow_query = '''
+                           select predictions_2017.id, parcelid, logerror, transactiondate
+                           from properties_2017
+                           join predictions_2017 using (parcelid)
+                           where latitude is not null
+                           and longitude is not null
+                           and propertylandusetypeid = 261
+                           and predictions_2017.transactiondate < :hwm
+                           '''
+            current = pd.read_sql(sqlalchemy.text(narrow_query), conn, params={'hwm': high_water_mark})
+            current['fingerprint'] = prediction_fingerprints(current).fingerprint.values
+            changed = ~current.fingerprint.isin(stored.fingerprint)
+            ids = current.id[changed].astype('int64').tolist()
+            for start in range(0, len(ids), batch_size):
+                id_list = ', '.join(str(i) for i in ids[start:start + batch_size])
+                delta.append(pd.read_sql(sqlalchemy.text(sql_query + f' and predictions_2017.id in ({id_list})'),
+                                         conn))
+    #empty reads come back as all object columns, leave them out of the concat
+    delta = [rows for rows in delta if len(rows)]
+    if not delta:
+        return 0
+    delta = dedupe_columns(pd.concat(delta, ignore_index=True))
+    df = read_zillow_cache(filename = filename)
+    #drop the cached versions of every fetched parcelid and transactiondate
+    new_keys = pd.MultiIndex.from_frame(prediction_fingerprints(delta)[['parcelid', 'transactiondate']])
+    old_keys = pd.MultiIndex.from_frame(prediction_fingerprints(df)[['parcelid', 'transactiondate']])
+    df = df[~old_keys.isin(new_keys)]
+    #new rows carry on the cache's index
+    start = df.index.max() + 1 if len(df) else 0
+    delta.index = pd.RangeIndex(start, start + len(delta))
+    write_zillow_cache(pd.concat([df, delta[df.columns]]), filename, fingerprint_filename)
+    return len(delta)
+
+
+###################################  Zillow Cache Functions ###################################
+
+
+def dedupe_columns(df):
+    '''
+    This function renames repeated column names the same way read_csv does
+    ('id', 'id.1', ...) so the joined data can be stored in a columnar file
+    '''
+    seen = {}
+    columns = []
+    for col in df.columns:
+        if col in seen:
+            seen[col] += 1
+            columns.append(f'{col}.{seen[col]}')
+        else:
+            seen[col] = 0
+            columns.append(col)
+    df.columns = columns
     return df
 
 
+def dtype_stats(df, stats=None):
+    '''
+    This function collects what is needed to pick a compact dtype for each column:
+    whether it is integer, float or something else, its min and max,
+    and whether float32 holds every value exactly.
+    Pass the stats from earlier chunks in to keep adding to them.
+    '''
+    if stats is None:
+        stats = {}
+    for col in df.columns:
+        stat = stats.setdefault(col, {'kind': None, 'nulls': False, 'min': np.inf, 'max': -np.inf,
+                                      'float32': True, 'type': None})
+        values = df[col]
+        stat['nulls'] |= bool(values.isnull().any())
+        #an all null chunk says nothing else about the column
+        if values.isnull().all():
+            continue
+        if pd.api.types.is_bool_dtype(values):
+            stat['kind'] = 'other'
+        elif pd.api.types.is_integer_dtype(values):
+            if stat['kind'] is None:
+                stat['kind'] = 'int'
+        elif pd.api.types.is_float_dtype(values):
+            stat['kind'] = 'float'
+            #float32 is only kept if every value round trips exactly
+            stat['float32'] &= bool(((values.astype('float32') == values) | values.isnull()).all())
+        else:
+            stat['kind'] = 'other'
+            if stat['type'] is None:
+                stat['type'] = pa.array(values.dropna(), from_pandas=True).type
+            continue
+        stat['min'] = min(stat['min'], values.min())
+        stat['max'] = max(stat['max'], values.max())
+    return stats
+
+
+def plan_dtypes(stats):
+    '''
+    This function turns dtype_stats into a dtype for each column:
+    the smallest integer type that fits, float32 when it is exact,
+    and categorical codes for the '*desc' lookup columns
+    '''
+    dtypes = {}
+    for col, stat in stats.items():
+        if stat['kind'] == 'int' and stat['nulls']:
+            #an integer column with nulls in some chunk has to be a float column
+            exact = max(abs(stat['min']), abs(stat['max'])) <= 2**24
+            dtypes[col] = 'float32' if exact else 'float64'
+        elif stat['kind'] == 'int':
+            for dtype in ['int8', 'int16', 'int32', 'int64']:
+                if np.iinfo(dtype).min <= stat['min'] and stat['max'] <= np.iinfo(dtype).max:
+                    dtypes[col] = dtype
+                    break
+        elif stat['kind'] == 'float':
+            dtypes[col] = 'float32' if stat['float32'] else 'float64'
+        elif stat['kind'] == 'other' and col.endswith('desc'):
+            dtypes[col] = 'category'
+    return dtypes
+
+
+def arrow_schema(stats):
+    '''
+    This function builds the parquet schema for the cache from dtype_stats,
+    '*desc' columns are stored as strings and read back as categoricals
+    '''
+    dtypes = plan_dtypes(stats)
+    fields = []
+    for col, stat in stats.items():
+        if dtypes.get(col, 'category') != 'category':
+            fields.append(pa.field(col, pa.from_numpy_dtype(np.dtype(dtypes[col]))))
+        elif stat['type'] is not None:
+            fields.append(pa.field(col, stat['type']))
+        else:
+            #never saw a value, store the column as all null floats
+            fields.append(pa.field(col, pa.float64()))
+    fields.append(pa.field('__index_level_0__', pa.int64()))
+    return pa.schema(fields)
+
+
+def optimize_dtypes(df):
+    '''
+    This function shrinks the zillow df in memory by downcasting integer columns,
+    downcasting float columns to float32 only when no value changes,
+    and storing the '*desc' lookup columns as categorical codes
+    '''
+    return df.astype(plan_dtypes(dtype_stats(df)))
+
+
+def write_zillow_cache(df, filename=zillow_cache_file, fingerprint_filename=zillow_fingerprint_file):
+    '''
+    This function takes in the raw zillow df, shrinks its dtypes,
+    writes it to a compressed parquet file along with its row fingerprints
+    and returns the df
+    '''
+    df = optimize_dtypes(dedupe_columns(df))
+    df.to_parquet(filename, compression='zstd')
+    if has_predictions(df):
+        prediction_fingerprints(df).to_parquet(fingerprint_filename)
+    return df
+
+
+def read_zillow_cache(columns=None, filename=zillow_cache_file):
+    '''
+    This function reads the zillow parquet cache,
+    only loading the columns asked for if columns is given
+    (they come back in the same order they are stored in)
+    '''
+    schema = pq.read_schema(filename)
+    if columns is not None:
+        columns = [c for c in schema.names if c in set(columns)]
+    #string lookup columns come back as categoricals
+    desc_columns = [field.name for field in schema
+                    if field.name.endswith('desc')
+                    and (pa.types.is_string(field.type) or pa.types.is_large_string(field.type))]
+    return pd.read_parquet(filename, columns=columns, read_dictionary=desc_columns)
+
+
+# sha256 of the cache file, remembered by path, size and modified time
+cache_digests = {}
+
+
+def cache_fingerprint(filename=zillow_cache_file):
+    '''
+    This function returns a sha256 hex digest of the cache file's contents,
+    it is only recomputed when the file's size or modified time changes
+    '''
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in cache_digests:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        cache_digests[key] = digest.hexdigest()
+    return cache_digests[key]
+
+
+def migrate_csv_cache(csv_filename=zillow_csv_file, filename=zillow_cache_file):
+    '''
+    This function converts an old zillow_df.csv cache into the parquet cache
+    and returns the df, the csv file is left in place
+    '''
+    df = pd.read_csv(csv_filename, index_col=0)
+    return write_zillow_cache(df, filename)
+
+
+###################################  Get Zillow Data Function ###################################
+
+
+@instrumented
+def get_zillow_data(cached=True, columns=None, chunksize=None, refresh=False, client_join=False,
+                    check_changed=False):
+    '''
+    This function reads in zillow data from CodeUp database if cached == False
+    or if there is no local cache, otherwise it reads the parquet cache
+    (migrating an old zillow_df.csv first if that is all there is), returns df.
+    Pass a list of columns to only load those columns from the cache.
+    Pass a chunksize to stream the database read in chunks of that many rows,
+    only selecting the given columns (zillow_columns if none are given).
+    Pass refresh=True to add only the rows newer than the cache before reading it,
+    with check_changed=True to also refetch older rows that changed.
+    Pass client_join=True to read the lookup tables separately and join them in memory.
+    '''
+    if not cached or not (os.path.isfile(zillow_cache_file) or os.path.isfile(zillow_csv_file)):
+        if client_join:
+            client_join_zillow_data(columns)
+        elif chunksize:
+            stream_zillow_data(chunksize, zillow_columns if columns is None else columns)
+        else:
+            new_zillow_data()
+    elif not os.path.isfile(zillow_cache_file):
+        migrate_csv_cache()
+    elif refresh:
+        refresh_zillow_cache(check_changed)
+    #always hand back what is in the cache so every path returns the same dtypes
+    return read_zillow_cache(columns)
+
+
 def new_iris_data():
     '''
     This function reads the iris data from CodeUp database into a df,
     write it to a csv file, and returns the df.
     '''
     sql_query = 'SELECT * FROM measurements AS m JOIN species USING (species_id)'
-    df = pd.read_sql(sql_query, get_connection('iris_db'))
+    with connect('iris_db') as conn:
+        df = pd.read_sql(sqlalchemy.text(sql_query), conn)
     df.to_csv('iris.csv')
     return df
 
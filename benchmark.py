@@ -0,0 +1,281 @@
+import os
+import time
+import platform
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from acquire import get_zillow_data, zillow_columns, write_chunked_cache
+from wrangle_zillow import (fill_nulls, remove_outliers, create_features, handle_missing_values,
+                            fused_clean_zillow, unneeded_columns, wrangle_zillow, scaled_zillow_columns,
+                            clear_stage_cache)
+from explore import k_sweep, run_kmeans
+import model
+
+
+################################# Timing Function #################################
+
+def measure(func, *args, trace_memory = False, **kwargs):
+    '''
+    This function runs func once and returns its result, its wall time in seconds
+    and, if trace_memory == True, the peak memory tracemalloc saw in MB
+    (tracing slows func down, so time and memory are best measured in separate runs)
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6 if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+################################# Wrangle Pipeline Benchmark #################################
+
+def staged_clean_zillow(df):
+    '''
+    This function runs the cleaning steps of wrangle_zillow one stage at a time
+    '''
+    df = fill_nulls(df)
+    df = remove_outliers(df)
+    df = create_features(df)
+    df = handle_missing_values(df, .6, .6)
+    df = df.drop(columns = unneeded_columns)
+    df.dropna(inplace = True)
+    return df
+
+
+def compare_wrangle_pipelines(df = None, repeat = 3):
+    '''
+    This function times the staged and fused cleaning of the zillow data
+    (read from the cache if df is not given), checks they give identical results
+    and returns a df with the best of repeat wall times and the peak memory of each
+    '''
+    if df is None:
+        df = get_zillow_data(columns = zillow_columns)
+    results = {}
+    rows = []
+    for name, func, args in [('staged', staged_clean_zillow, ()),
+                             ('fused', fused_clean_zillow, (.6, .6))]:
+        #the staged functions change their input, give every run a fresh copy
+        seconds = min(measure(func, df.copy(), *args)[1] for _ in range(repeat))
+        results[name], _, peak_mb = measure(func, df.copy(), *args, trace_memory = True)
+        rows.append({'pipeline': name,
+                     'seconds': seconds,
+                     'peak_mb': peak_mb,
+                     'rows': len(results[name])})
+    pd.testing.assert_frame_equal(results['staged'], results['fused'])
+    return pd.DataFrame(rows).set_index('pipeline')
+
+
+################################# Synthetic Zillow Data #################################
+
+#share of parcels, center latitude and longitude (in millionths of a degree) and spread of each county
+synthetic_counties = {6037.: (.65, 34.05e6, -118.25e6, .25e6, 3101.),
+                      6059.: (.26, 33.70e6, -117.85e6, .15e6, 1286.),
+                      6111.: (.09, 34.25e6, -119.05e6, .15e6, 2061.)}
+#heatingorsystemtypeid: (share of parcels, heatingorsystemdesc), about a third of parcels have none
+synthetic_heating = {2.: (.42, 'Central'), 7.: (.18, 'Floor/Wall'), 24.: (.015, 'Yes'),
+                     6.: (.008, 'Forced air'), 20.: (.002, 'Solar'), 13.: (.001, 'None'),
+                     18.: (.002, 'Radiant'), 1.: (.001, 'Baseboard'), 10.: (.001, 'Gravity')}
+
+
+def synthetic_zillow_data(n, seed = 123, start = 0):
+    '''
+    This function returns n rows shaped like the new_zillow_data join
+    (zillow_columns with the same dtypes and roughly the same null patterns),
+    with realistic fips, latitude and longitude, and heating system distributions.
+    start offsets the ids so chunks can be generated separately
+    '''
+    rng = np.random.default_rng([seed, start])
+    def with_nulls(values, prop_null):
+        values = np.asarray(values, dtype = float)
+        values[rng.random(n) < prop_null] = np.nan
+        return values
+    fips = rng.choice(list(synthetic_counties), n, p = [c[0] for c in synthetic_counties.values()])
+    county = pd.DataFrame(synthetic_counties, index = ['share', 'lat', 'long', 'spread', 'region']).T.loc[fips]
+    heating_ids = np.array(list(synthetic_heating))
+    heating_p = np.array([h[0] for h in synthetic_heating.values()])
+    heating = rng.choice(np.append(heating_ids, np.nan), n, p = np.append(heating_p, 1 - heating_p.sum()))
+    bathroomcnt = rng.choice([0, 1, 1.5, 2, 2.5, 3, 3.5, 4, 5, 8], n, p = [.01, .16, .02, .40, .08, .20, .03, .06, .03, .01])
+    sqft = np.round(rng.lognormal(7.45, .42, n))
+    lot = np.round(rng.lognormal(8.9, .6, n))
+    structure_value = np.round(rng.lognormal(12.0, .7, n))
+    land_value = np.round(rng.lognormal(12.3, .9, n))
+    tract = fips * 1e6 + rng.integers(100000, 999999, n)
+    df = pd.DataFrame({
+        'id': np.arange(start, start + n) + 1,
+        'parcelid': np.arange(start, start + n) + 10711738,
+        'bathroomcnt': bathroomcnt,
+        'bedroomcnt': rng.choice([0, 1, 2, 3, 4, 5, 6, 8], n, p = [.01, .04, .20, .41, .24, .07, .02, .01]).astype(float),
+        'buildingqualitytypeid': with_nulls(rng.integers(1, 13, n), .3),
+        'calculatedbathnbr': with_nulls(bathroomcnt, .01),
+        'calculatedfinishedsquarefeet': with_nulls(sqft, .003),
+        'finishedsquarefeet12': with_nulls(sqft, .04),
+        'fips': fips,
+        'fireplacecnt': with_nulls(rng.integers(1, 4, n), .87),
+        'fullbathcnt': with_nulls(np.floor(bathroomcnt), .01),
+        'heatingorsystemtypeid': heating,
+        'latitude': np.round(rng.normal(county.lat, county.spread)),
+        'longitude': np.round(rng.normal(county.long, county.spread)),
+        'lotsizesquarefeet': with_nulls(lot, .007),
+        'poolcnt': with_nulls(np.ones(n), .79),
+        'propertycountylandusecode': rng.choice(['0100', '122', '1111', '0101'], n, p = [.6, .25, .1, .05]),
+        'propertylandusetypeid': np.full(n, 261.),
+        'propertyzoningdesc': np.where(rng.random(n) < .35, None, rng.choice(['LAR1', 'LARS', 'SCUR2', 'LCR1'], n)),
+        'rawcensustractandblock': tract,
+        'regionidcity': with_nulls(rng.integers(1, 400, n) * 100, .02),
+        'regionidcounty': county.region.to_numpy(),
+        'regionidzip': with_nulls(rng.integers(95982, 97344, n), .005),
+        'roomcnt': rng.choice([0, 4, 5, 6, 7, 8], n, p = [.75, .03, .05, .07, .06, .04]).astype(float),
+        'unitcnt': with_nulls(rng.choice([1, 2], n, p = [.995, .005]), .33),
+        'yearbuilt': with_nulls(rng.integers(1880, 2016, n), .003),
+        'structuretaxvaluedollarcnt': with_nulls(structure_value, .002),
+        'taxvaluedollarcnt': structure_value + land_value,
+        'assessmentyear': np.full(n, 2016.),
+        'landtaxvaluedollarcnt': land_value,
+        'taxamount': with_nulls(np.round((structure_value + land_value) * rng.normal(.0125, .002, n), 2), .002),
+        'censustractandblock': with_nulls(tract * 1e8 + rng.integers(1000, 9999, n), .02),
+        'id.1': np.arange(start, start + n) + 1,
+        'logerror': rng.standard_t(3, n) * .05,
+        'transactiondate': (pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.integers(0, 260, n), 'D')).strftime('%Y-%m-%d'),
+    })
+    df['heatingorsystemdesc'] = df.heatingorsystemtypeid.map({k: v[1] for k, v in synthetic_heating.items()})
+    df['propertylandusedesc'] = 'Single Family Residential'
+    df.index = pd.RangeIndex(start, start + n)
+    return df[zillow_columns]
+
+
+def write_synthetic_cache(n, filename, seed = 123, chunksize = 500000):
+    '''
+    This function writes n synthetic rows to a parquet cache in the same format
+    as the real one, chunksize rows at a time so 10 million rows fit in memory
+    '''
+    chunks = (synthetic_zillow_data(min(chunksize, n - start), seed, start) for start in range(0, n, chunksize))
+    return write_chunked_cache(chunks, filename, filename.replace('.parquet', '_fingerprints.parquet'))
+
+
+################################# Benchmark Suite #################################
+
+#where the suite keeps one synthetic cache per size and its results
+benchmark_dir = 'benchmarks'
+benchmark_results_file = 'benchmark_results.csv'
+#the scaled features the clustering and model benchmarks use
+benchmark_cluster_vars = ['calculatedfinishedsquarefeet_scaled', 'acres_scaled']
+benchmark_features = ['bedroomcnt_scaled', 'calculatedfinishedsquarefeet_scaled', 'age_scaled', 'acres_scaled',
+                      'taxrate_scaled', 'structure_dollar_per_sqft_scaled', 'land_dollar_per_sqft_scaled']
+
+
+def benchmark_stages():
+    '''
+    This function returns (stage, function, setup) for every benchmarked stage,
+    setup runs untimed before each run and returns the arguments of the function
+    '''
+    def wrangled():
+        clear_stage_cache()
+        return ()
+    def scaled():
+        #time only the scaling, the wrangled splits come from the stage cache
+        clear_stage_cache()
+        wrangle_zillow()
+        return ()
+    def splits():
+        train, validate, test = scaled_zillow_columns()
+        return train, validate
+    def xy(split):
+        #time real fits, not answers remembered from the run before
+        model.feature_rankings.clear()
+        model.poly_models.clear()
+        return split[benchmark_features], split[['error']]
+    def train_xy():
+        return xy(splits()[0])
+    def train_validate_xy():
+        train, validate = splits()
+        return xy(train) + xy(validate)
+    return [('get_zillow_data', lambda: get_zillow_data(columns = zillow_columns), lambda: ()),
+            ('wrangle_zillow', wrangle_zillow, wrangled),
+            ('scaled_zillow_columns', scaled_zillow_columns, scaled),
+            ('k_sweep', lambda train: k_sweep(benchmark_cluster_vars, train, ks = range(2, 10)), lambda: splits()[:1]),
+            ('run_kmeans', lambda train: run_kmeans(5, benchmark_cluster_vars, 'cluster', train), lambda: splits()[:1]),
+            ('select_kbest', lambda X, y: model.select_kbest(X, y, 3), train_xy),
+            ('rfe', lambda X, y: model.rfe(X, y, 3), train_xy),
+            ('linearReg_train', model.linearReg_train, train_xy),
+            ('lassoLars_train', model.lassoLars_train, train_xy),
+            ('poly_linearReg_train', lambda X, y: model.poly_linearReg_train(X, y, 2), train_xy),
+            ('linearReg_validate', model.linearReg_validate, train_validate_xy),
+            ('lassoLars_validate', model.lassoLars_validate, train_validate_xy),
+            ('poly_linearReg_validate', lambda *a: model.poly_linearReg_validate(*a, 2), train_validate_xy)]
+
+
+def run_benchmarks(sizes = (10000, 100000, 1000000), repeat = 3, trace_memory = True, seed = 123,
+                   directory = benchmark_dir, results_file = benchmark_results_file):
+    '''
+    This function benchmarks the pipeline on synthetic caches of every size in sizes
+    (10 thousand to 10 million rows), so no database credentials are needed.
+    Every stage gets the best of repeat wall times and, with trace_memory,
+    the peak memory of one more traced run. A stage that fails records its error.
+    The results are appended to directory/results_file with the run's time and versions
+    for comparing against earlier runs with compare_benchmarks, and returned
+    '''
+    os.makedirs(directory, exist_ok = True)
+    run = {'run_at': datetime.now(timezone.utc).isoformat(timespec = 'seconds'),
+           'python': platform.python_version(),
+           'pandas': pd.__version__,
+           'numpy': np.__version__,
+           'sklearn': sklearn.__version__}
+    rows = []
+    home = os.getcwd()
+    for n in sizes:
+        #every size gets its own folder, the pipeline reads the cache and saves its stages there
+        size_dir = os.path.join(directory, f'{n}_rows_seed_{seed}')
+        os.makedirs(size_dir, exist_ok = True)
+        os.chdir(size_dir)
+        try:
+            if not os.path.isfile('zillow_df.parquet'):
+                write_synthetic_cache(n, 'zillow_df.parquet', seed)
+            for stage, func, setup in benchmark_stages():
+                row = dict(run, size = n, stage = stage, seconds = np.nan, peak_mb = np.nan, error = None)
+                try:
+                    times = []
+                    for _ in range(repeat):
+                        args = setup()
+                        times.append(measure(func, *args)[1])
+                    row['seconds'] = min(times)
+                    if trace_memory:
+                        args = setup()
+                        row['peak_mb'] = measure(func, *args, trace_memory = True)[2]
+                except Exception as e:
+                    row['error'] = f'{type(e).__name__}: {e}'
+                rows.append(row)
+            clear_stage_cache()
+        finally:
+            os.chdir(home)
+    results = pd.DataFrame(rows)
+    filename = os.path.join(directory, results_file)
+    results.to_csv(filename, mode = 'a', header = not os.path.isfile(filename), index = False)
+    return results
+
+
+def compare_benchmarks(results, baseline = None, directory = benchmark_dir, results_file = benchmark_results_file):
+    '''
+    This function compares a run_benchmarks result with a baseline run
+    (the previous run saved in directory/results_file by default) and returns
+    the seconds and peak memory of both and their ratios by size and stage,
+    ratios above 1 are slower or bigger than the baseline
+    '''
+    if baseline is None:
+        saved = pd.read_csv(os.path.join(directory, results_file))
+        earlier = saved[saved.run_at < results.run_at.min()]
+        baseline = earlier[earlier.run_at == earlier.run_at.max()]
+    compared = results.merge(baseline, on = ['size', 'stage'], suffixes = ('', '_baseline'))
+    compared['seconds_ratio'] = compared.seconds / compared.seconds_baseline
+    compared['peak_mb_ratio'] = compared.peak_mb / compared.peak_mb_baseline
+    return compared.set_index(['size', 'stage'])[['seconds', 'seconds_baseline', 'seconds_ratio',
+                                                  'peak_mb', 'peak_mb_baseline', 'peak_mb_ratio']]
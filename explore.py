@@ -1,37 +1,109 @@
 import pandas as pd 
+import numpy as np
+import os
+import json
 import matplotlib.pyplot as plt
 
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score, calinski_harabasz_score
 
+from scaling import save_scaler, load_scaler
+from zillow_features import scaler_artifact_file, cluster_model_dir, model_artifact_file
+from instrument import instrumented
+from workers import worker_pool, worker_data, set_worker_data
 
 
 
 
-def elbow_plot(cluster_vars, X_train_scaled):
-    # elbow method to identify good k for us
-    ks = range(2,20)
+
+def elbow_plot(cluster_vars, X_train_scaled, ks = range(2,20), **kwargs):
+    # elbow method to identify good k for us, kwargs go to k_sweep
+    results = k_sweep(cluster_vars, X_train_scaled, ks = ks, plot = True, **kwargs)
+    print(results)
+
+
+def fit_k(k, init = 'k-means++', minibatch = False, random_state = 13):
+    # fit one k on the feature matrix k_sweep shares as worker_data['sweep_X']
+    model = MiniBatchKMeans if minibatch else KMeans
+    # an array of starting centroids is a single init
+    n_init = 1 if isinstance(init, np.ndarray) else 'auto'
+    return model(n_clusters = k, init = init, n_init = n_init, random_state = random_state).fit(worker_data['sweep_X'])
+
+
+@instrumented
+def furthest_row(X, centers, chunksize = 100000):
+    # returns the position of the row of X furthest from its nearest center,
+    # chunksize rows at a time with ||x - c||^2 = ||x||^2 - 2x.c + ||c||^2
+    # so no rows x centers x features array is ever made
+    centers = np.asarray(centers, dtype = np.float64)
+    center_norms = (centers ** 2).sum(axis = 1)
+    best_row, best_distance = 0, -np.inf
+    for start in range(0, len(X), chunksize):
+        chunk = X[start:start + chunksize].astype(np.float64)
+        distance = ((chunk ** 2).sum(axis = 1) + (center_norms - 2 * chunk @ centers.T).min(axis = 1))
+        if distance.max() > best_distance:
+            best_row, best_distance = start + distance.argmax(), distance.max()
+    return best_row
+
+
+def k_sweep(cluster_vars, X_train_scaled, ks = range(2,20), workers = None, minibatch = False,
+            sample_size = None, warm_start = False, score_sample_size = 2000, random_state = 13, plot = False):
+    # fits every k in ks and returns a dataframe indexed by k with the inertia,
+    # silhouette and calinski harabasz score of each
+    # the features are converted once to a contiguous float32 array
+    X = np.ascontiguousarray(X_train_scaled[cluster_vars], dtype = np.float32)
+    rng = np.random.default_rng(random_state)
+    # fit on a random subsample of rows, scored on all of them
+    X_fit = X[np.sort(rng.choice(len(X), sample_size, replace = False))] if sample_size and sample_size < len(X) else X
     
-    # empty list to hold inertia (sum of squares)
-    sse = []
-
-    # loop through each k, fit kmeans, get inertia
-    for k in ks:
-        kmeans = KMeans(n_clusters=k)
-        kmeans.fit(X_train_scaled[cluster_vars])
-        # inertia
-        sse.append(kmeans.inertia_)
-
-    print(pd.DataFrame(dict(k=ks, sse=sse)))
-
-    # plot k with inertia
-    plt.plot(ks, sse, 'bx-')
-    plt.xlabel('k')
-    plt.ylabel('SSE')
-    plt.title('Elbow method to find optimal k')
+    if warm_start or (workers or os.cpu_count()) == 1:
+        # fit the ks one after another, with warm_start each k starts
+        # from the k-1 centroids plus the row furthest from them
+        set_worker_data({'sweep_X': X_fit})
+        models = []
+        for k in ks:
+            init = 'k-means++'
+            if warm_start and models and models[-1].n_clusters == k - 1:
+                centers = models[-1].cluster_centers_
+                init = np.vstack([centers, X_fit[furthest_row(X_fit, centers)]]).astype(np.float32)
+            models.append(fit_k(k, init, minibatch, random_state))
+    else:
+        # every k is independent, so fit them across a process pool
+        with worker_pool(workers, sweep_X = X_fit) as pool:
+            models = list(pool.map(fit_k, ks, ['k-means++'] * len(ks), [minibatch] * len(ks), [random_state] * len(ks)))
+    
+    # silhouette is quadratic in rows so it is scored on a sample
+    scored = rng.choice(len(X), min(len(X), score_sample_size), replace = False)
+    rows = []
+    for model in models:
+        labels = model.predict(X)
+        # both scores need between 2 and n - 1 distinct labels
+        n_labels = len(np.unique(labels[scored]))
+        rows.append(dict(k = model.n_clusters,
+                         # inertia over every row, even when fit on a sample
+                         inertia = -model.score(X),
+                         silhouette = silhouette_score(X[scored], labels[scored]) if 1 < n_labels < len(scored) else np.nan,
+                         calinski_harabasz = calinski_harabasz_score(X, labels) if 1 < len(np.unique(labels)) < len(X) else np.nan))
+    results = pd.DataFrame(rows).set_index('k')
+    
+    if plot:
+        plot_k_sweep(results)
+    return results
+
+
+def plot_k_sweep(results):
+    # plot k with inertia, silhouette and calinski harabasz
+    fig, axes = plt.subplots(1, 3, figsize = (15, 4))
+    for ax, col in zip(axes, results.columns):
+        ax.plot(results.index, results[col], 'bx-')
+        ax.set_xlabel('k')
+        ax.set_ylabel(col)
+    axes[0].set_title('Elbow method to find optimal k')
     plt.show()
 
 
-def run_kmeans(k, cluster_vars, cluster_col_name, X_train_scaled):
+@instrumented
+def run_kmeans(k, cluster_vars, cluster_col_name, X_train_scaled, save_as = None, scaler = None):
     # create kmeans object
     kmeans = KMeans(n_clusters = k, random_state = 13)
     kmeans.fit(X_train_scaled[cluster_vars])
@@ -39,16 +111,96 @@ def run_kmeans(k, cluster_vars, cluster_col_name, X_train_scaled):
     train_clusters = pd.DataFrame(kmeans.predict(X_train_scaled[cluster_vars]),
                               columns=[cluster_col_name],
                               index=X_train_scaled.index)
+    # save the model under a name so other splits can be assigned without refitting
+    if save_as is not None:
+        save_cluster_model(save_as, kmeans, cluster_vars, scaler)
     
     return train_clusters, kmeans
 
 
 def add_to_train(train_clusters, cluster_col_name, X_train, X_train_scaled):
-    # concatenate cluster id
-    X_train = pd.concat([X_train, train_clusters], axis=1)
-    
-    # concatenate cluster id
-    X_train_scaled = pd.concat([X_train_scaled, train_clusters], 
-                               axis=1)
+    # attach the cluster id as a compact categorical column instead of concatenating copies
+    labels = cluster_labels(train_clusters[cluster_col_name].to_numpy(), train_clusters[cluster_col_name].max() + 1)
+    X_train[cluster_col_name] = pd.Series(labels, index = train_clusters.index)
+    X_train_scaled[cluster_col_name] = pd.Series(labels, index = train_clusters.index)
                                
-    return X_train, X_train_scaled
\ No newline at end of file
+    return X_train, X_train_scaled
+
+
+########################### Cluster Model Store ###########################
+
+# every saved cluster model is a folder in cluster_model_dir with its centroids and scaler
+
+
+def save_cluster_model(name, kmeans, cluster_vars, scaler = None, directory = cluster_model_dir):
+    # saves the centroids of a fitted kmeans with the columns it was fit on,
+    # and the scaler that made any '_scaled' columns
+    path = os.path.join(directory, name)
+    os.makedirs(path, exist_ok = True)
+    model = dict(name = name,
+                 cluster_vars = list(cluster_vars),
+                 centroids = kmeans.cluster_centers_.tolist(),
+                 inertia = float(kmeans.inertia_))
+    with open(os.path.join(path, model_artifact_file), 'w') as f:
+        json.dump(model, f)
+    if scaler is not None:
+        save_scaler(scaler, os.path.join(path, scaler_artifact_file))
+
+
+def load_cluster_model(name, directory = cluster_model_dir):
+    # loads a model saved by save_cluster_model,
+    # centroids come back as a float32 array and scaler is None if none was saved
+    path = os.path.join(directory, name)
+    with open(os.path.join(path, model_artifact_file)) as f:
+        model = json.load(f)
+    model['centroids'] = np.asarray(model['centroids'], dtype = np.float32)
+    scaler_file = os.path.join(path, scaler_artifact_file)
+    model['scaler'] = load_scaler(scaler_file) if os.path.isfile(scaler_file) else None
+    return model
+
+
+def list_cluster_models(directory = cluster_model_dir):
+    # names of every saved cluster model
+    if not os.path.isdir(directory):
+        return []
+    return sorted(n for n in os.listdir(directory) if os.path.isfile(os.path.join(directory, n, model_artifact_file)))
+
+
+def cluster_labels(codes, k):
+    # int8 codes (int16 past 127 clusters) as a categorical of cluster ids
+    codes = np.asarray(codes, dtype = np.int8 if k <= 127 else np.int16)
+    return pd.Categorical.from_codes(codes, categories = range(k))
+
+
+def cluster_features(df, model):
+    # the model's cluster_vars as a float32 array, '_scaled' columns the df
+    # does not have are scaled from the unscaled column with the saved scaler
+    X = np.empty((len(df), len(model['cluster_vars'])), dtype = np.float32)
+    scaler = model['scaler']
+    for j, col in enumerate(model['cluster_vars']):
+        if col in df.columns:
+            X[:, j] = df[col].to_numpy(dtype = np.float32)
+        elif scaler is not None and col.endswith('_scaled') and col[:-len('_scaled')] in scaler.feature_names_in_:
+            i = list(scaler.feature_names_in_).index(col[:-len('_scaled')])
+            X[:, j] = df[col[:-len('_scaled')]].to_numpy(dtype = np.float64) * scaler.scale_[i] + scaler.min_[i]
+        else:
+            raise KeyError(f'{col} is not in the df and cannot be scaled')
+    return X
+
+
+@instrumented
+def assign_clusters(df, model, cluster_col_name, chunksize = 100000):
+    # labels every row of df with its nearest centroid, chunksize rows at a time,
+    # and attaches the labels to df in place as an int8 categorical column
+    # model is a name in the cluster store or a model from load_cluster_model
+    if isinstance(model, str):
+        model = load_cluster_model(model)
+    centroids = model['centroids']
+    # ||x - c||^2 = ||x||^2 - 2x.c + ||c||^2, and ||x||^2 does not change the nearest c
+    centroid_norms = (centroids ** 2).sum(axis = 1)
+    codes = np.empty(len(df), dtype = np.int16)
+    for start in range(0, len(df), chunksize):
+        X = cluster_features(df.iloc[start:start + chunksize], model)
+        codes[start:start + len(X)] = (centroid_norms - 2 * X @ centroids.T).argmin(axis = 1)
+    df[cluster_col_name] = pd.Series(cluster_labels(codes, len(centroids)), index = df.index)
+    return df
@@ -0,0 +1,199 @@
+import os
+import time
+import tracemalloc
+import functools
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+#instrumented stages only record anything once this is True,
+#set it with enable_instrumentation or ZILLOW_INSTRUMENT=1 in the environment
+instrumentation_enabled = os.environ.get('ZILLOW_INSTRUMENT') == '1'
+#whether enabled stages also trace python allocations (slower)
+instrumentation_trace_memory = False
+#one dict per finished stage, in the order they finished
+stage_records = []
+#[traced memory at the start, running peak] of every traced stage that has not finished yet
+open_stage_peaks = []
+#running RSS peak of every stage that has not finished yet, in MB
+open_rss_peaks = []
+
+
+################################# Instrumentation Functions #################################
+
+def rss_status():
+    '''
+    This function returns the process's current RSS and its RSS high water mark in MB
+    from /proc/self/status, or (None, None) where /proc is not available
+    '''
+    status = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    status[line.split(':')[0]] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return status.get('VmRSS'), status.get('VmHWM')
+
+
+def reset_rss_peak():
+    '''
+    This function resets the process's RSS high water mark to its current RSS
+    so the next peak belongs to the stage that is starting, returns whether it could
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def enable_instrumentation(trace_memory = False):
+    '''
+    This function turns on recording for every instrumented stage,
+    trace_memory=True also records the tracemalloc delta and peak of each stage
+    '''
+    global instrumentation_enabled, instrumentation_trace_memory
+    instrumentation_enabled = True
+    instrumentation_trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_instrumentation():
+    '''
+    This function turns recording off again, the records are kept
+    '''
+    global instrumentation_enabled, instrumentation_trace_memory
+    if instrumentation_trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    instrumentation_enabled = False
+    instrumentation_trace_memory = False
+
+
+@contextmanager
+def instrumentation(trace_memory = False):
+    '''
+    This function records the instrumented stages run inside a with block
+    '''
+    enable_instrumentation(trace_memory)
+    try:
+        yield stage_records
+    finally:
+        disable_instrumentation()
+
+
+def clear_stage_records():
+    '''
+    This function forgets every recorded stage
+    '''
+    stage_records.clear()
+
+
+def frame_shape(value):
+    '''
+    This function returns the rows and columns of a DataFrame,
+    or the total rows and the columns of the first of a tuple of DataFrames
+    (like the train, validate and test splits), or None for anything else
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value), value.shape[1] if value.ndim == 2 else 1
+    if isinstance(value, tuple):
+        frames = [v for v in value if isinstance(v, pd.DataFrame)]
+        if frames:
+            return sum(len(f) for f in frames), frames[0].shape[1]
+    return None, None
+
+
+def instrumented(func):
+    '''
+    This function wraps a pipeline stage so that, while instrumentation is enabled,
+    every call records its wall and cpu time, its change in RSS, the highest RSS reached
+    during the stage and how far that is above the RSS it started with,
+    the tracemalloc delta and peak if traced, and the shape of the first DataFrame in
+    and of what comes out. While disabled the stage runs as is.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not instrumentation_enabled:
+            return func(*args, **kwargs)
+        frames_in = [a for a in list(args) + list(kwargs.values()) if isinstance(a, pd.DataFrame)]
+        rows_in, cols_in = frame_shape(frames_in[0]) if frames_in else (None, None)
+        tracing = instrumentation_trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            #keep the enclosing stage's peak before this stage resets it
+            if open_stage_peaks:
+                open_stage_peaks[-1][1] = max(open_stage_peaks[-1][1], peak)
+            open_stage_peaks.append([current, current])
+            tracemalloc.reset_peak()
+        depth = len([r for r in stage_records if r.get('open')])
+        record = {'stage': func.__qualname__, 'module': func.__module__, 'depth': depth, 'open': True}
+        stage_records.append(record)
+        rss_start, rss_peak = rss_status()
+        #keep the enclosing stage's RSS peak before this stage resets the high water mark
+        if open_rss_peaks and rss_peak is not None:
+            open_rss_peaks[-1] = max(open_rss_peaks[-1], rss_peak)
+        open_rss_peaks.append(rss_start or 0)
+        peak_reset = rss_start is not None and reset_rss_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            rss_end, rss_peak = rss_status()
+            running_peak = open_rss_peaks.pop()
+            record['rss_delta_mb'] = None if rss_end is None else rss_end - rss_start
+            #without a reset the high water mark may belong to an earlier stage
+            stage_peak = max(rss_peak, running_peak) if peak_reset else None
+            record['stage_peak_rss_mb'] = stage_peak
+            record['peak_rss_increase_mb'] = None if stage_peak is None else stage_peak - rss_start
+            if open_rss_peaks and stage_peak is not None:
+                open_rss_peaks[-1] = max(open_rss_peaks[-1], stage_peak)
+            if tracing:
+                after, peak = tracemalloc.get_traced_memory()
+                start, running_peak = open_stage_peaks.pop()
+                peak = max(peak, running_peak)
+                record['mem_delta_mb'] = (after - start) / 1e6
+                record['mem_peak_mb'] = (peak - start) / 1e6
+                if open_stage_peaks:
+                    open_stage_peaks[-1][1] = max(open_stage_peaks[-1][1], peak)
+            del record['open']
+            #finished stages are listed in the order they finished
+            stage_records.pop(next(i for i, r in enumerate(stage_records) if r is record))
+            stage_records.append(record)
+        record['rows_in'], record['cols_in'] = rows_in, cols_in
+        record['rows_out'], record['cols_out'] = frame_shape(result)
+        return result
+    return wrapper
+
+
+def stage_report():
+    '''
+    This function returns the recorded stages as a DataFrame, one row per call
+    '''
+    columns = ['stage', 'module', 'depth', 'wall_s', 'cpu_s', 'rss_delta_mb', 'stage_peak_rss_mb', 'peak_rss_increase_mb',
+               'mem_delta_mb', 'mem_peak_mb',
+               'rows_in', 'cols_in', 'rows_out', 'cols_out']
+    report = pd.DataFrame([r for r in stage_records if 'open' not in r], columns = columns)
+    #shapes are missing for stages that do not take or return a DataFrame
+    shape_columns = ['rows_in', 'cols_in', 'rows_out', 'cols_out']
+    report[shape_columns] = report[shape_columns].astype('Int64')
+    return report
+
+
+def stage_report_json(filename = None):
+    '''
+    This function returns the recorded stages as JSON
+    and also writes it to filename if given
+    '''
+    report = stage_report().to_json(orient = 'records', indent = 2)
+    if filename is not None:
+        with open(filename, 'w') as f:
+            f.write(report)
+    return report
@@ -2,26 +2,38 @@ import pandas as pd
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
+import os
+import json
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
-from sklearn.feature_selection import SelectKBest, f_regression
-from sklearn.feature_selection import RFE
 from sklearn.linear_model import LinearRegression, LassoLars
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.preprocessing import PolynomialFeatures
 from sklearn.metrics import mean_squared_error
+from sklearn.base import BaseEstimator, RegressorMixin
+
+from instrument import instrumented
+from workers import worker_pool, worker_data, set_worker_data
 
 
 ########################### Pairplot Function ###########################
 
 
-def plot_variable_pairs(df, drop_scaled_columns = True):
+def plot_variable_pairs(df, drop_scaled_columns = True, max_rows = None, stratify = None,
+                        bins = 50, filename = None, workers = None):
     '''
     This function takes in a DataFrame and plots all of the 
     pairwise relationships along with the regression line for each pair.
+    With max_rows set it uses the large data mode of plot_pair_densities instead,
+    so the time taken is bounded by max_rows however big df is.
     '''
     if drop_scaled_columns:
         scaled_columns = [c for c in df.columns if c.endswith('_scaled')]
         df = df.drop(columns = scaled_columns)
+    if max_rows is not None:
+        return plot_pair_densities(df, max_rows, stratify, bins, filename, workers)
     #to see all the plots at once, pairplot but with more customizations
     g = sns.PairGrid(df)
     #the plots is the diagonal will be a distribution plot
@@ -31,32 +43,91 @@ def plot_variable_pairs(df, drop_scaled_columns = True):
     plt.show()
     return g
 
+
+def sample_rows(df, max_rows, stratify = None, random_state = 123):
+    '''
+    This function returns at most max_rows rows of df, sampled within
+    each value of the stratify column in proportion to its size when one is given
+    '''
+    if len(df) <= max_rows:
+        return df
+    if stratify is None:
+        return df.sample(max_rows, random_state = random_state)
+    return df.groupby(stratify, group_keys = False, observed = True).sample(frac = max_rows / len(df), random_state = random_state)
+
+
+def pair_panel(i, j, bins):
+    '''
+    This function bins one panel of the pairplot with numpy,
+    a histogram on the diagonal and otherwise a 2-D histogram
+    with the least squares line computed in closed form,
+    from the sampled values plot_pair_densities shares as worker_data['pair_values']
+    '''
+    values = worker_data['pair_values']
+    if i == j:
+        x = values[:, j]
+        return np.histogram(x[np.isfinite(x)], bins = bins)
+    x, y = values[:, j], values[:, i]
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins = bins)
+    #slope = cov(x, y) / var(x)
+    x_mean, y_mean = x.mean(), y.mean()
+    var = ((x - x_mean)**2).sum()
+    slope = ((x - x_mean) * (y - y_mean)).sum() / var if var else 0
+    return counts, x_edges, y_edges, slope, y_mean - slope * x_mean
+
+
+def plot_pair_densities(df, max_rows = 100000, stratify = None, bins = 50, filename = None, workers = None):
+    '''
+    This function is the large data pairplot. It samples at most max_rows rows
+    (stratified by the stratify column when given), bins every panel in parallel
+    across a process pool with pair_panel and draws each as a rasterized density image
+    with its regression line, no points and no bootstrapped confidence intervals.
+    With filename set the figure is saved there instead of shown.
+    Returns the figure.
+    '''
+    df = sample_rows(df, max_rows, stratify)
+    columns = df.select_dtypes(include = ['number', 'bool']).columns.drop(stratify, errors = 'ignore')
+    values = df[columns].to_numpy(dtype = np.float64)
+    pairs = [(i, j) for i in range(len(columns)) for j in range(len(columns))]
+    with worker_pool(workers, pair_values = values) as pool:
+        panels = list(pool.map(pair_panel, *zip(*pairs), [bins] * len(pairs)))
+    
+    n = len(columns)
+    fig, axes = plt.subplots(n, n, figsize = (2 * n, 2 * n), squeeze = False)
+    for (i, j), panel in zip(pairs, panels):
+        ax = axes[i, j]
+        if i == j:
+            counts, edges = panel
+            ax.stairs(counts, edges, fill = True)
+        else:
+            counts, x_edges, y_edges, slope, intercept = panel
+            ax.imshow(counts.T, origin = 'lower', aspect = 'auto', cmap = 'Blues', norm = 'log',
+                      extent = (x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), interpolation = 'nearest')
+            ax.plot(x_edges[[0, -1]], intercept + slope * x_edges[[0, -1]], color = 'red')
+        if i == n - 1:
+            ax.set_xlabel(columns[j])
+        if j == 0:
+            ax.set_ylabel(columns[i])
+    fig.tight_layout()
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename)
+        plt.close(fig)
+    return fig
+
 ########################### SelectKBest Function ###########################
 
 def select_kbest(predictors, target, number_of_features):
     '''
     This function takes in predictors(features), a target variable and the number of top features we want
     and returns the top features that correlate with the target variable.
+    The F-scores are computed once per predictors and target by rank_features,
+    so trying another number_of_features is instant.
     '''
-    #Initialize the f_selector object, 
-    #which defines the test for scoring the features 
-    #and the number of features we want to keep,
-    f_selector = SelectKBest(f_regression, k = number_of_features)
-    
-    #fitting the data into the model
-    #scoring, ranking and identifying the top k features
-    f_selector = f_selector.fit(predictors, target)
-    
-    #creating a list of the features that remain
-    f_support = f_selector.get_support()
-
-    #We get a list of the feature names selected from 
-    #X_train using .loc with our mask, 
-    #using .columns to get the column names, 
-    #and convert the values to a list using .tolist()
-    f_feature = predictors.iloc[:, f_support].columns.tolist()
-
-    return f_feature
+    return top_features(cached_ranking(predictors, target), number_of_features, method = 'f')
 
 
 ########################### RFE Function ###########################
@@ -65,46 +136,114 @@ def rfe(predictors, target, number_of_features):
     '''
     This function takes in predictors(features), a target variable and the number of top features we want 
     and returns the top features that lead to the best performing linear regression model. 
+    The whole elimination order is computed once per predictors and target by rank_features,
+    so trying another number_of_features is instant.
     '''
-    #Initialize the linear regression object
-    lm = LinearRegression()
-    
-    #Initialize the RFE object, 
-    #setting the hyperparameters to be our linear regression 
-    #(as the algorithm to test the features on) 
-    #and the number of features to be returned
-    rfe = RFE(lm, number_of_features)
-
-    #Fit the RFE object to our data. 
-    #(This means create multiple linear regression models,
-    #find the one that performs best, 
-    #and identify the predictors that are used in that model.
-    #Those are the features we want.)
-    #Transform our X dataframe to include only 
-    #the 'number_of_features' that performed the best
-    rfe.fit_transform(predictors, target)
-
-    #Create a mask to hold a list of the features that were selected or not
-    mask = rfe.support_
-
-    #We get a list of the feature names selected from 
-    #X_train using .loc with our mask, 
-    #using .columns to get the column names, 
-    #and convert the values to a list using .tolist()
-    X_reduced_scaled_rfe = predictors.iloc[:, mask].columns.tolist()
-
-    return X_reduced_scaled_rfe
+    return top_features(cached_ranking(predictors, target), number_of_features, method = 'rfe')
+
+
+########################### Feature Ranking Functions ###########################
+
+#rankings by predictors and target, shared by select_kbest and rfe
+feature_rankings = {}
+
+
+@instrumented
+def rank_features(predictors, target):
+    '''
+    This function ranks every feature two ways from one pass over the data.
+    It factors the centered data once as X = QR, then
+    f_score is f_regression's F statistic from the correlations, and
+    rfe_rank is the order recursive feature elimination with a LinearRegression
+    drops the features in (1 is kept longest), solving each step's regression
+    on the small R instead of refitting on the rows.
+    Returns a DataFrame indexed by feature in the predictors' order.
+    '''
+    X = np.asarray(predictors, dtype = np.float64)
+    y = np.ravel(target).astype(np.float64)
+    n = len(X)
+    #centering fits the intercept
+    y = y - y.mean()
+    #F = r^2 / (1 - r^2) * (n - 2), with r computed in the same order as f_regression
+    #so tied features get bit for bit equal scores and break ties the same way
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r = (y @ X) / np.sqrt(np.einsum('ij,ij->i', X.T, X.T) - n * X.mean(axis = 0)**2) / np.linalg.norm(y)
+        #a constant feature or target has no correlation
+        r[np.isnan(r)] = 0
+        f_score = r**2 / (1 - r**2) * (n - 2)
+    #a perfect correlation gets the largest score instead of inf, and no score is NaN
+    f_score[np.isinf(f_score)] = np.finfo(np.float64).max
+    f_score[np.isnan(f_score)] = 0
+    X = X - X.mean(axis = 0)
+    #||X[:, S]b - y|| = ||R[:, S]b - Q'y|| up to a constant, for any subset S of columns,
+    #and R keeps the conditioning of X where X'X would square it
+    q, R = np.linalg.qr(X)
+    qty = q.T @ y
+    #eliminate the feature with the smallest absolute coefficient until one is left
+    remaining = list(range(X.shape[1]))
+    rfe_rank = np.ones(X.shape[1], dtype = int)
+    while len(remaining) > 1:
+        coef = np.linalg.lstsq(R[:, remaining], qty, rcond = None)[0]
+        eliminated = remaining.pop(int(np.argmin(np.abs(coef))))
+        rfe_rank[eliminated] = len(remaining) + 1
+    return pd.DataFrame({'f_score': f_score, 'rfe_rank': rfe_rank}, index = pd.Index(predictors.columns, name = 'feature'))
+
+
+def top_features(ranking, k, method = 'f'):
+    '''
+    This function returns the top k features of a rank_features ranking
+    by f_score (method='f', like SelectKBest) or rfe_rank (method='rfe', like RFE),
+    in the predictors' order. k='all' or a k larger than the number of features keeps them all
+    '''
+    k = len(ranking) if k == 'all' else min(k, len(ranking))
+    if method == 'f':
+        #SelectKBest breaks ties by column order (rank_features leaves no NaN scores)
+        scores = ranking.f_score.to_numpy()
+        mask = np.zeros(len(ranking), dtype = bool)
+        mask[np.argsort(scores, kind = 'mergesort')[len(ranking) - k:]] = True
+    elif method == 'rfe':
+        mask = (ranking.rfe_rank <= k).to_numpy()
+    else:
+        raise ValueError(f'unknown method {method}')
+    return ranking.index[mask].tolist()
+
+
+def cached_ranking(predictors, target):
+    '''
+    This function returns rank_features for these predictors and target,
+    ranking them only the first time it is asked for
+    '''
+    key = data_fingerprint(predictors, target)
+    if key not in feature_rankings:
+        feature_rankings[key] = rank_features(predictors, target)
+    return feature_rankings[key]
+
+
+def rank_features_by_cluster(predictors, target, cluster_col, workers = None):
+    '''
+    This function ranks the features within every cluster of cluster_col
+    in parallel across a process pool and returns a dict of rankings by cluster
+    '''
+    features = predictors.drop(columns = cluster_col)
+    clusters = np.asarray(predictors[cluster_col])
+    y = np.ravel(target)
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {cluster: pool.submit(rank_features, features[clusters == cluster], y[clusters == cluster])
+                   for cluster in pd.unique(clusters)}
+        return {cluster: future.result() for cluster, future in futures.items()}
+
 
 ########################### Train Modeling Functions ###########################
 
 
+@instrumented
 def linearReg_train(X_train, y_train):
     '''
     This function creates a multilinear reression model 
     for the training dataframe
     '''
     # Initialize the Linear Regression Object
-    lm = LinearRegression(normalize=True)
+    lm = LinearRegression()
     # Fitting the data to model
     lm.fit(X_train, y_train)
     # Get the predicted y-values
@@ -114,6 +253,7 @@ def linearReg_train(X_train, y_train):
     return lm_rmse
 
 
+@instrumented
 def lassoLars_train(X_train, y_train, alpha = 1):
     '''
     This function creates a LASSO and LARS model 
@@ -130,35 +270,32 @@ def lassoLars_train(X_train, y_train, alpha = 1):
     return lars_rmse
 
 
-def poly_linearReg_train(X_train, y_train, degrees):
+@instrumented
+def poly_linearReg_train(X_train, y_train, degrees, interaction_only = False):
     '''
     This function creates a polynomial regression model 
     for the training dataframe
     '''
-    pf = PolynomialFeatures(degree=degrees)
-    # Fitting and transforming the data to model
-    X_train_squared = pf.fit_transform(X_train)
-    # Feeding the squared data into our linear model
-    lm_squared = LinearRegression()
-    # Fitting the squared data to model
-    lm_squared.fit(X_train_squared, y_train)
+    # Fitting the model chunk by chunk, or reusing the fit from an earlier call
+    poly_model = cached_poly_model(X_train, y_train, degrees, interaction_only)
     # Get the predicted y-values
-    lm_squared_pred = lm_squared.predict(X_train_squared)
+    lm_squared_pred = predict_poly_chunked(poly_model, X_train)
     # Evaluate RMSE
-    lm_squared_rmse = mean_squared_error(y_train, lm_squared_pred)**(1/2)
+    lm_squared_rmse = mean_squared_error(np.ravel(y_train), lm_squared_pred)**(1/2)
     return lm_squared_rmse
 
 
 ########################### Validate Modeling Functions ###########################
 
 
+@instrumented
 def linearReg_validate(X_train, y_train, X_validate, y_validate):
     '''
     This function creates a multilinear reression model 
     for the validate or test dataframe
     '''
     # Initialize the Linear Regression Object
-    lm = LinearRegression(normalize=True)
+    lm = LinearRegression()
     # Fitting the data to model
     lm.fit(X_train, y_train)
     # Get the predicted y-values
@@ -167,6 +304,7 @@ def linearReg_validate(X_train, y_train, X_validate, y_validate):
     lm_rmse = mean_squared_error(y_validate, lm_pred)**(1/2)
     return lm_rmse
 
+@instrumented
 def lassoLars_validate(X_train, y_train, X_validate, y_validate, alpha = 1):
     '''
     This function creates a LASSO and LARS model 
@@ -181,22 +319,284 @@ def lassoLars_validate(X_train, y_train, X_validate, y_validate, alpha = 1):
     lars_rmse = mean_squared_error(y_validate, lars_pred)**(1/2)
     return lars_rmse
 
-def poly_linearReg_validate(X_train, y_train, X_validate, y_validate, degrees):
+@instrumented
+def poly_linearReg_validate(X_train, y_train, X_validate, y_validate, degrees, interaction_only = False):
     '''
     This function creates a polynomial regression model 
     for the validate or test dataframe
     '''
-    pf = PolynomialFeatures(degree=degrees)
-    # Fitting and transforming the train data to model
-    X_train_squared = pf.fit_transform(X_train)
-    # Fitting the validate data to model
-    X_validate_squared = pf.transform(X_validate)
-    # Feeding the squared data into our linear model
-    lm_squared = LinearRegression()
-    # Fitting the squared data to model
-    lm_squared.fit(X_train_squared, y_train)
+    # Fitting the model chunk by chunk, or reusing the fit from poly_linearReg_train
+    poly_model = cached_poly_model(X_train, y_train, degrees, interaction_only)
     # Get the predicted y-values
-    lm_squared_pred = lm_squared.predict(X_validate_squared)
+    lm_squared_pred = predict_poly_chunked(poly_model, X_validate)
     # Evaluate RMSE
-    lm_squared_rmse = mean_squared_error(y_validate, lm_squared_pred)**(1/2)
-    return lm_squared_rmse
\ No newline at end of file
+    lm_squared_rmse = mean_squared_error(np.ravel(y_validate), lm_squared_pred)**(1/2)
+    return lm_squared_rmse
+
+
+########################### Chunked Polynomial Regression ###########################
+
+#fitted polynomial models by train data and settings, shared by the train and validate functions
+poly_models = {}
+
+
+def fit_poly_chunked(X, y, degrees, interaction_only = False, chunksize = 10000):
+    '''
+    This function fits a polynomial regression without ever holding the expanded features.
+    The features are scaled by their largest absolute value, expanded chunksize rows at a time
+    and only X'X and X'y of the expansion are kept and solved at the end.
+    interaction_only=True only keeps products of distinct features.
+    Returns a dict with the fitted PolynomialFeatures, the input scale and the coefficients.
+    '''
+    values = np.asarray(X, dtype = np.float64)
+    y = np.ravel(y).astype(np.float64)
+    #scaling keeps high powers of large columns like square feet from swamping X'X
+    scale = np.abs(values).max(axis = 0)
+    scale[scale == 0] = 1
+    pf = PolynomialFeatures(degree = degrees, interaction_only = interaction_only).fit(values[:1] / scale)
+    n_terms = pf.n_output_features_
+    xtx = np.zeros((n_terms, n_terms))
+    xty = np.zeros(n_terms)
+    for start in range(0, len(values), chunksize):
+        expanded = pf.transform(values[start:start + chunksize] / scale)
+        xtx += expanded.T @ expanded
+        xty += expanded.T @ y[start:start + chunksize]
+    #equilibrate the normal equations and take the least squares solution in case terms are collinear
+    d = np.sqrt(np.diag(xtx))
+    d[d == 0] = 1
+    coef = np.linalg.lstsq(xtx / np.outer(d, d), xty / d, rcond = None)[0] / d
+    return {'pf': pf, 'scale': scale, 'coef': coef}
+
+
+def predict_poly_chunked(poly_model, X, chunksize = 10000):
+    '''
+    This function predicts with a model from fit_poly_chunked, expanding chunksize rows at a time
+    '''
+    values = np.asarray(X, dtype = np.float64)
+    predictions = np.empty(len(values))
+    for start in range(0, len(values), chunksize):
+        predictions[start:start + chunksize] = poly_model['pf'].transform(values[start:start + chunksize] / poly_model['scale']) @ poly_model['coef']
+    return predictions
+
+
+def cached_poly_model(X_train, y_train, degrees, interaction_only = False):
+    '''
+    This function returns fit_poly_chunked's model for this train data and settings,
+    fitting it only the first time it is asked for
+    '''
+    key = (data_fingerprint(X_train, y_train), degrees, interaction_only)
+    if key not in poly_models:
+        poly_models[key] = fit_poly_chunked(X_train, y_train, degrees, interaction_only)
+    return poly_models[key]
+
+
+class ChunkedPolynomialRegression(BaseEstimator, RegressorMixin):
+    '''
+    This class wraps fit_poly_chunked and predict_poly_chunked as an estimator
+    so the evaluation harness and the per cluster models fit polynomial regressions
+    exactly like the poly_linearReg functions, without the dense expansion
+    '''
+    def __init__(self, degrees = 2, interaction_only = False, chunksize = 10000):
+        self.degrees = degrees
+        self.interaction_only = interaction_only
+        self.chunksize = chunksize
+
+    def fit(self, X, y):
+        self.poly_model_ = fit_poly_chunked(X, y, self.degrees, self.interaction_only, self.chunksize)
+        return self
+
+    def predict(self, X):
+        return predict_poly_chunked(self.poly_model_, X, self.chunksize)
+
+
+########################### Evaluation Harness ###########################
+
+#where evaluate_models saves fitted models
+model_cache_dir = 'zillow_models'
+
+
+def make_model(config):
+    '''
+    This function builds the unfitted model a config describes,
+    config['model'] is 'linear', 'lassolars' (with 'alpha') or 'poly' (with 'degrees')
+    '''
+    if config['model'] == 'linear':
+        return LinearRegression()
+    if config['model'] == 'lassolars':
+        return LassoLars(alpha = config.get('alpha', 1))
+    if config['model'] == 'poly':
+        return ChunkedPolynomialRegression(config['degrees'], config.get('interaction_only', False))
+    raise ValueError(f"unknown model {config['model']}")
+
+
+def config_name(config):
+    '''
+    This function returns a config's 'name', or a readable name built from its settings.
+    Up to 4 features are listed by name, more are named by their count and a short hash
+    '''
+    if 'name' in config:
+        return config['name']
+    settings = []
+    for k, v in config.items():
+        if k == 'features':
+            features = list(map(str, v))
+            v = ','.join(features) if len(features) <= 4 else \
+                f"{len(features)}:{hashlib.sha256(json.dumps(features).encode()).hexdigest()[:8]}"
+        settings.append(f'{k}={v}')
+    return ' '.join(settings)
+
+
+def config_rows(config, X, y):
+    '''
+    This function returns the config's features and rows of one split,
+    config['cluster'] = (column, value) keeps only the rows of that cluster
+    '''
+    if 'cluster' in config:
+        column, value = config['cluster']
+        rows = (X[column] == value).to_numpy()
+        X, y = X[rows], y[rows]
+    if 'features' in config:
+        X = X[config['features']]
+    return X, np.ravel(y)
+
+
+def data_fingerprint(X, y):
+    '''
+    This function hashes the values, index and columns of a split
+    so a changed train split never reuses a saved model
+    '''
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(X).to_numpy().tobytes())
+    digest.update(pd.util.hash_pandas_object(pd.DataFrame(np.ravel(y), index = X.index)).to_numpy().tobytes())
+    digest.update(json.dumps(list(map(str, X.columns))).encode())
+    return digest.hexdigest()
+
+
+def config_key(config, fingerprint):
+    '''
+    This function returns the key a config's fitted model is saved under
+    '''
+    return hashlib.sha256(json.dumps([config, fingerprint], sort_keys = True, default = str).encode()).hexdigest()
+
+
+def fit_and_score(config, key, cache):
+    '''
+    This function fits a config on train once (or loads it from the model cache)
+    and returns the RMSE of that one fit on every split,
+    the splits are the ones evaluate_models shares as worker_data['eval_splits']
+    '''
+    eval_splits = worker_data['eval_splits']
+    filename = os.path.join(model_cache_dir, f'{key}.pkl')
+    if cache and os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            model = pickle.load(f)
+    else:
+        model = make_model(config).fit(*config_rows(config, *eval_splits['train']))
+        if cache:
+            os.makedirs(model_cache_dir, exist_ok = True)
+            with open(filename + f'.{os.getpid()}.tmp', 'wb') as f:
+                pickle.dump(model, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(filename + f'.{os.getpid()}.tmp', filename)
+    scores = {}
+    for split, (X, y) in eval_splits.items():
+        X, y = config_rows(config, X, y)
+        scores[split] = mean_squared_error(y, model.predict(X))**(1/2) if len(y) else np.nan
+    return scores
+
+
+@instrumented
+def evaluate_models(configs, splits, workers = None, cache = True):
+    '''
+    This function takes in a list of model configs and a dict of splits,
+    e.g. {'train': (X_train, y_train), 'validate': (X_validate, y_validate)},
+    fits every config once on train, scores that fit on every split
+    and returns one table of RMSE with a row per config and a column per split.
+    Configs are dicts like {'model': 'lassolars', 'alpha': 1, 'features': [...],
+    'cluster': ('size_cluster', 0)} and are fit in parallel across a process pool.
+    With cache=True fitted models are saved in model_cache_dir by a hash of the config
+    and the train data, so rerunning a config only scores it
+    '''
+    names = [config_name(config) for config in configs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'configs {duplicates} have the same name, give them different names')
+    fingerprint = data_fingerprint(*splits['train'])
+    keys = [config_key(config, fingerprint) for config in configs]
+    if workers == 1 or len(configs) == 1:
+        set_worker_data({'eval_splits': splits})
+        scores = [fit_and_score(config, key, cache) for config, key in zip(configs, keys)]
+    else:
+        with worker_pool(workers, eval_splits = splits) as pool:
+            scores = list(pool.map(fit_and_score, configs, keys, [cache] * len(configs)))
+    results = pd.DataFrame(scores, index = names)
+    results.index.name = 'model'
+    return results
+
+
+########################### Per Cluster Modeling Functions ###########################
+
+
+def fit_cluster_model(config, X, y):
+    '''
+    This function fits the model a config describes on one cluster's rows
+    '''
+    return make_model(config).fit(X, y)
+
+
+@instrumented
+def train_cluster_models(X_train, y_train, cluster_col, config = None, features = None, workers = None):
+    '''
+    This function takes in the train split with the cluster column made by explore.run_kmeans
+    and fits one model per cluster (a make_model config, e.g. {'model': 'lassolars', 'alpha': 1},
+    a linear regression when none is given).
+    Every cluster's rows are sliced out once and only that slice is sent
+    to its fit, the clusters are fit in parallel across a process pool.
+    Returns a dict with the cluster column, the features and a model per cluster.
+    '''
+    if config is None:
+        config = {'model': 'linear'}
+    if features is None:
+        features = [c for c in X_train.columns if c != cluster_col]
+    X = X_train[features].to_numpy(dtype = np.float64)
+    y = np.ravel(y_train)
+    clusters = np.asarray(X_train[cluster_col])
+    rows = {cluster: np.flatnonzero(clusters == cluster) for cluster in pd.unique(clusters)}
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {cluster: pool.submit(fit_cluster_model, config, X[r], y[r]) for cluster, r in rows.items()}
+        models = {cluster: future.result() for cluster, future in futures.items()}
+    return {'cluster_col': cluster_col, 'features': features, 'models': models}
+
+
+@instrumented
+def predict_cluster_models(cluster_models, X):
+    '''
+    This function routes every row of X to its cluster's model and returns the predictions.
+    When every model is linear (linear or lassolars) the coefficients are gathered per row
+    and everything is predicted in one vectorized pass,
+    otherwise each cluster's rows are predicted together.
+    Rows of a cluster with no model are NaN.
+    '''
+    models = cluster_models['models']
+    values = X[cluster_models['features']].to_numpy(dtype = np.float64)
+    clusters = np.asarray(X[cluster_models['cluster_col']])
+    #position of each row's model, -1 when its cluster has no model
+    order = list(models)
+    lookup = pd.Series(np.arange(len(order)), index = pd.Index(order, dtype = object))
+    index = lookup.reindex(pd.Index(clusters, dtype = object)).fillna(-1).to_numpy(dtype = np.int64)
+    if all(hasattr(model, 'coef_') for model in models.values()):
+        coefs = np.vstack([np.ravel(models[c].coef_) for c in order] + [np.full(values.shape[1], np.nan)])
+        intercepts = np.array([float(np.ravel(models[c].intercept_)[0]) for c in order] + [np.nan])
+        return np.einsum('ij,ij->i', values, coefs[index]) + intercepts[index]
+    predictions = np.full(len(values), np.nan)
+    for i, cluster in enumerate(order):
+        rows = np.flatnonzero(index == i)
+        if len(rows):
+            predictions[rows] = np.ravel(models[cluster].predict(values[rows]))
+    return predictions
+
+
+def cluster_models_rmse(cluster_models, X, y):
+    '''
+    This function returns the RMSE of the per cluster models on a split
+    '''
+    return mean_squared_error(np.ravel(y), predict_cluster_models(cluster_models, X))**(1/2)
@@ -0,0 +1,100 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+
+import sklearn.preprocessing
+
+from zillow_features import scaler_artifact_file
+
+
+#bump this when the saved scaler's format changes
+scaler_version = 1
+
+
+################################# Scaler Functions #################################
+
+def fit_scaler(chunks, scaler = None):
+    '''
+    This function fits a MinMaxScaler one chunk at a time,
+    chunks is any iterable of dfs with the columns to scale.
+    Pass a scaler to keep fitting it, empty chunks are skipped
+    '''
+    if scaler is None:
+        scaler = sklearn.preprocessing.MinMaxScaler()
+    for chunk in chunks:
+        if len(chunk):
+            scaler.partial_fit(chunk)
+    return scaler
+
+
+def merge_scalers(scalers):
+    '''
+    This function merges MinMaxScalers fit on different partitions of the data
+    into one scaler with the overall min and max, unfitted scalers are skipped
+    '''
+    merged = sklearn.preprocessing.MinMaxScaler()
+    samples = 0
+    for scaler in scalers:
+        if not hasattr(scaler, 'data_min_'):
+            continue
+        merged.feature_range = scaler.feature_range
+        fit_scaler([pd.DataFrame([scaler.data_min_, scaler.data_max_], columns = scaler.feature_names_in_)], merged)
+        samples += scaler.n_samples_seen_
+    if samples:
+        merged.n_samples_seen_ = samples
+    return merged
+
+
+def scale_columns(df, scaler, columns = None):
+    '''
+    This function replaces columns (the columns the scaler was fit on by default)
+    with float32 '_scaled' columns, written straight into one preallocated array
+    so the rest of the df is never copied more than once
+    '''
+    if columns is None:
+        columns = list(scaler.feature_names_in_)
+    #one row per column so every scaled column is contiguous
+    scaled = np.empty((len(columns), len(df)), dtype = np.float32)
+    for j, col in enumerate(columns):
+        np.multiply(df[col].to_numpy(dtype = np.float64), scaler.scale_[j], out = scaled[j], casting = 'same_kind')
+        np.add(scaled[j], scaler.min_[j], out = scaled[j], casting = 'same_kind')
+    if scaler.clip:
+        np.clip(scaled, *scaler.feature_range, out = scaled)
+    df = df.drop(columns = columns)
+    for j, col in enumerate(columns):
+        df[col + '_scaled'] = scaled[j]
+    return df
+
+
+def save_scaler(scaler, filename = scaler_artifact_file, params = None):
+    '''
+    This function saves a fitted MinMaxScaler's parameters as json
+    with the scaler_version and, if given, the settings of the data it was fit on
+    '''
+    artifact = {'version': scaler_version,
+                'params': params,
+                'columns': list(scaler.feature_names_in_),
+                'feature_range': list(scaler.feature_range),
+                'clip': scaler.clip,
+                'data_min': scaler.data_min_.tolist(),
+                'data_max': scaler.data_max_.tolist(),
+                'n_samples_seen': int(scaler.n_samples_seen_)}
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(artifact, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def load_scaler(filename = scaler_artifact_file):
+    '''
+    This function rebuilds the MinMaxScaler saved by save_scaler
+    without needing the data it was fit on
+    '''
+    with open(filename) as f:
+        artifact = json.load(f)
+    if artifact['version'] != scaler_version:
+        raise ValueError(f"{filename} is scaler version {artifact['version']}, expected {scaler_version}")
+    scaler = sklearn.preprocessing.MinMaxScaler(feature_range = tuple(artifact['feature_range']), clip = artifact['clip'])
+    fit_scaler([pd.DataFrame([artifact['data_min'], artifact['data_max']], columns = artifact['columns'])], scaler)
+    scaler.n_samples_seen_ = artifact['n_samples_seen']
+    return scaler
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+from zillow_features import (null_fill_values, heating_fill_value, new_features, county_dummies, heating_dummies,
+                             scaler_artifact_file, cluster_model_dir, model_artifact_file)
+
+#where save_scoring_model writes the scoring artifact
+scoring_model_dir = 'scoring_model'
+#the scorer score uses when none is passed, loaded on first use
+default_scorer = None
+
+
+################################# Saving Functions #################################
+
+def linear_params(regressor):
+    '''
+    This function returns the coefficients and intercept of a fitted linear regressor
+    '''
+    if not hasattr(regressor, 'coef_'):
+        raise ValueError(f'{type(regressor).__name__} is not a linear model, only linear models can be scored')
+    return {'coef': np.ravel(regressor.coef_).tolist(), 'intercept': float(np.ravel(regressor.intercept_)[0])}
+
+
+def save_scoring_model(regressor, features, scaler = None, cluster_model = None, cluster_col = None,
+                       directory = scoring_model_dir):
+    '''
+    This function saves everything score needs to predict logerror for new parcels.
+    regressor is a fitted LinearRegression or LassoLars on features,
+    or the dict from model.train_cluster_models (one linear model per cluster).
+    scaler is the MinMaxScaler that made any '_scaled' features
+    and cluster_model the name of an explore.save_cluster_model model that assigns cluster_col
+    '''
+    #only saving needs the heavy modules
+    from scaling import save_scaler
+    os.makedirs(directory, exist_ok = True)
+    if isinstance(regressor, dict):
+        cluster_col = regressor['cluster_col']
+        features = regressor['features']
+        models = {str(cluster): linear_params(m) for cluster, m in regressor['models'].items()}
+    else:
+        models = {'all': linear_params(regressor)}
+    artifact = {'features': list(features),
+                'cluster_model': cluster_model,
+                'cluster_col': cluster_col,
+                'models': models}
+    with open(os.path.join(directory, model_artifact_file), 'w') as f:
+        json.dump(artifact, f)
+    if scaler is not None:
+        save_scaler(scaler, os.path.join(directory, scaler_artifact_file))
+
+
+################################# Loading Functions #################################
+
+def read_scaler(filename):
+    '''
+    This function reads a save_scaler json into a dict of column: (scale, min)
+    the same way MinMaxScaler computes them, without importing sklearn
+    '''
+    with open(filename) as f:
+        artifact = json.load(f)
+    low, high = artifact['feature_range']
+    data_min = np.asarray(artifact['data_min'], dtype = np.float64)
+    data_range = np.asarray(artifact['data_max'], dtype = np.float64) - data_min
+    #MinMaxScaler treats a constant column as a range of 1
+    data_range[data_range == 0] = 1
+    scale = (high - low) / data_range
+    return {col: (scale[i], low - data_min[i] * scale[i], artifact['clip'], (low, high))
+            for i, col in enumerate(artifact['columns'])}
+
+
+def load_scorer(directory = scoring_model_dir, cluster_dir = cluster_model_dir):
+    '''
+    This function loads a scoring artifact once into a scorer:
+    the scaler, the cluster centroids and their scaler, and the coefficients
+    of each model stacked for one vectorized predict
+    '''
+    with open(os.path.join(directory, model_artifact_file)) as f:
+        scorer = json.load(f)
+    scaler_file = os.path.join(directory, scaler_artifact_file)
+    scorer['scaler'] = read_scaler(scaler_file) if os.path.isfile(scaler_file) else {}
+    scorer['centroids'] = None
+    if scorer['cluster_model'] is not None:
+        path = os.path.join(cluster_dir, scorer['cluster_model'])
+        with open(os.path.join(path, model_artifact_file)) as f:
+            cluster_model = json.load(f)
+        scorer['cluster_vars'] = cluster_model['cluster_vars']
+        scorer['centroids'] = np.asarray(cluster_model['centroids'], dtype = np.float64)
+        #the cluster model's own scaler wins for its '_scaled' columns
+        cluster_scaler = os.path.join(path, scaler_artifact_file)
+        if os.path.isfile(cluster_scaler):
+            scorer['scaler'] = {**scorer['scaler'], **read_scaler(cluster_scaler)}
+    clusters = list(scorer['models'])
+    scorer['clusters'] = {cluster: i for i, cluster in enumerate(clusters)}
+    scorer['coef'] = np.array([scorer['models'][c]['coef'] for c in clusters] + [[np.nan] * len(scorer['features'])])
+    scorer['intercept'] = np.array([scorer['models'][c]['intercept'] for c in clusters] + [np.nan])
+    return scorer
+
+
+################################# Scoring Functions #################################
+
+def is_missing(value):
+    '''
+    This function checks for a missing field, None or NaN
+    '''
+    return value is None or value != value
+
+
+def record_column(records, column):
+    '''
+    This function returns one field of every record as a float array,
+    filled like fill_nulls and otherwise NaN where it is missing
+    '''
+    fill = null_fill_values.get(column, np.nan)
+    return np.array([fill if is_missing(r.get(column)) else r.get(column) for r in records], dtype = np.float64)
+
+
+def feature_column(records, column, scorer, columns):
+    '''
+    This function computes one feature for every record with the same fills and
+    feature definitions as fill_nulls and create_features, scaling '_scaled' features with the saved scaler.
+    columns remembers what was already computed for this batch
+    '''
+    if column in columns:
+        return columns[column]
+    get = lambda c: feature_column(records, c, scorer, columns)
+    if column.endswith('_scaled') and column[:-len('_scaled')] in scorer['scaler']:
+        scale, minimum, clip, feature_range = scorer['scaler'][column[:-len('_scaled')]]
+        values = get(column[:-len('_scaled')]) * scale + minimum
+        if clip:
+            values = np.clip(values, *feature_range)
+    elif column in new_features:
+        values = new_features[column](get)
+    elif column in county_dummies:
+        values = (get('fips') == county_dummies[column]).astype(np.float64)
+    elif column in heating_dummies:
+        heating = [heating_fill_value if is_missing(r.get('heatingorsystemdesc')) else r.get('heatingorsystemdesc')
+                   for r in records]
+        values = np.array([h == heating_dummies[column] for h in heating], dtype = np.float64)
+    elif column == scorer['cluster_col']:
+        values = assign_clusters(records, scorer, columns).astype(np.float64)
+    else:
+        values = record_column(records, column)
+    columns[column] = values
+    return values
+
+
+def assign_clusters(records, scorer, columns):
+    '''
+    This function returns the nearest centroid of every record
+    '''
+    X = np.column_stack([feature_column(records, c, scorer, columns) for c in scorer['cluster_vars']])
+    return ((scorer['centroids']**2).sum(axis = 1) - 2 * X @ scorer['centroids'].T).argmin(axis = 1)
+
+
+def score(records, scorer = None):
+    '''
+    This function predicts the logerror of one parcel (a dict of its fields)
+    or a micro-batch of them (a list of dicts, or a DataFrame) with a scorer from load_scorer,
+    the default scoring_model_dir artifact if none is given.
+    Returns a float for one dict and a numpy array otherwise, NaN where a field was missing
+    '''
+    global default_scorer
+    if scorer is None:
+        if default_scorer is None:
+            default_scorer = load_scorer()
+        scorer = default_scorer
+    single = isinstance(records, dict)
+    if single:
+        records = [records]
+    elif hasattr(records, 'to_dict'):
+        records = records.to_dict('records')
+    columns = {}
+    X = np.column_stack([feature_column(records, c, scorer, columns) for c in scorer['features']])
+    if scorer['centroids'] is None or 'all' in scorer['clusters']:
+        rows = np.zeros(len(records), dtype = np.int64)
+    else:
+        #route each record to its cluster's model, clusters with no model give NaN
+        clusters = assign_clusters(records, scorer, columns)
+        rows = np.array([scorer['clusters'].get(str(c), -1) for c in clusters], dtype = np.int64)
+    predictions = np.einsum('ij,ij->i', X, scorer['coef'][rows]) + scorer['intercept'][rows]
+    return float(predictions[0]) if single else predictions
+
+
+def main(argv = None):
+    '''
+    This function is the command line entry point, it reads parcels as json
+    (one object, a list of objects or one object per line) from a file or stdin
+    and prints one prediction per line
+    '''
+    parser = argparse.ArgumentParser(description = 'Predict the zillow logerror of new parcels')
+    parser.add_argument('input', nargs = '?', default = '-', help = 'json file of parcels, - for stdin')
+    parser.add_argument('--model-dir', default = scoring_model_dir)
+    parser.add_argument('--cluster-dir', default = cluster_model_dir)
+    args = parser.parse_args(argv)
+    scorer = load_scorer(args.model_dir, args.cluster_dir)
+    if args.input == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.input) as f:
+            text = f.read()
+    try:
+        records = json.loads(text)
+    except json.JSONDecodeError:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(records, dict):
+        records = [records]
+    for prediction in score(records, scorer):
+        print(json.dumps(None if np.isnan(prediction) else float(prediction)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+import sqlalchemy
+
+import acquire
+from acquire import (get_engine, dispose_engines, connect, stream_zillow_data, client_join_zillow_data, zillow_query,
+                     zillow_select, zillow_columns, write_chunked_cache, write_zillow_cache, read_zillow_cache,
+                     refresh_zillow_cache)
+from benchmark import synthetic_zillow_data
+
+
+#lookup tables of the zillow join, the typeid column and its desc column
+lookup_tables = {'airconditioningtype': 'airconditioning', 'architecturalstyletype': 'architecturalstyle',
+                 'buildingclasstype': 'buildingclass', 'heatingorsystemtype': 'heatingorsystem',
+                 'propertylandusetype': 'propertylanduse', 'storytype': 'story',
+                 'typeconstructiontype': 'typeconstruction'}
+
+
+def make_zillow_db(path, n):
+    '''
+    This function writes n synthetic rows into a sqlite file
+    with the tables and join keys of the zillow database
+    '''
+    df = synthetic_zillow_data(n)
+    con = sqlite3.connect(path)
+    properties = df.drop(columns = ['id.1', 'logerror', 'transactiondate', 'heatingorsystemdesc', 'propertylandusedesc'])
+    for prefix in lookup_tables.values():
+        if prefix + 'typeid' not in properties:
+            properties[prefix + 'typeid'] = None
+    properties.to_sql('properties_2017', con, index = False)
+    predictions = df[['id.1', 'parcelid', 'logerror', 'transactiondate']].rename(columns = {'id.1': 'id'})
+    predictions.to_sql('predictions_2017', con, index = False)
+    for table, prefix in lookup_tables.items():
+        lookup = pd.DataFrame({prefix + 'typeid': [1.], prefix + 'desc': ['Other']})
+        if table == 'heatingorsystemtype':
+            lookup = (df[['heatingorsystemtypeid', 'heatingorsystemdesc']].dropna()
+                      .drop_duplicates('heatingorsystemtypeid'))
+        elif table == 'propertylandusetype':
+            lookup = pd.DataFrame({'propertylandusetypeid': [261.], 'propertylandusedesc': ['Single Family Residential']})
+        lookup.to_sql(table, con, index = False)
+    df[['parcelid']].to_sql('unique_properties', con, index = False)
+    con.close()
+
+
+def test_stream_zillow_data_matches_read_sql(tmp_path):
+    '''
+    This function checks that streaming the join in chunks into the cache
+    gives the same frame as reading it with a single read_sql
+    '''
+    db = str(tmp_path / 'zillow.db')
+    streamed_file = str(tmp_path / 'streamed.parquet')
+    single_file = str(tmp_path / 'single.parquet')
+    make_zillow_db(db, 2500)
+    dispose_engines()
+    try:
+        get_engine('zillow', url = f'sqlite:///{db}')
+        rows = stream_zillow_data(chunksize = 400, filename = streamed_file,
+                                  fingerprint_filename = streamed_file + '.fingerprints')
+        with connect('zillow') as conn:
+            df = pd.read_sql(sqlalchemy.text(zillow_query.format(columns = zillow_select(zillow_columns))), conn)
+        assert acquire.connection_stats().loc['zillow', 'connects'] == 2
+    finally:
+        dispose_engines()
+    write_zillow_cache(df, single_file, single_file + '.fingerprints')
+    streamed = read_zillow_cache(filename = streamed_file)
+    single = read_zillow_cache(filename = single_file)
+    assert rows == len(single) == 2500
+    assert list(streamed.columns) == zillow_columns
+    #the chunks see their categories in a different order
+    for col in streamed.select_dtypes('category'):
+        streamed[col] = streamed[col].astype(str)
+        single[col] = single[col].astype(str)
+    pd.testing.assert_frame_equal(streamed, single)
+
+
+def test_stream_zillow_data_without_rows(tmp_path):
+    '''
+    This function checks that a query with no rows writes an empty cache with every column,
+    and that no chunks at all raises instead of leaving an old cache to be read
+    '''
+    db = str(tmp_path / 'zillow.db')
+    cache_file = str(tmp_path / 'zillow_df.parquet')
+    make_zillow_db(db, 100)
+    con = sqlite3.connect(db)
+    con.execute('delete from predictions_2017')
+    con.commit()
+    con.close()
+    dispose_engines()
+    try:
+        get_engine('zillow', url = f'sqlite:///{db}')
+        assert stream_zillow_data(chunksize = 30, filename = cache_file,
+                                  fingerprint_filename = cache_file + '.fingerprints') == 0
+    finally:
+        dispose_engines()
+    empty = read_zillow_cache(filename = cache_file)
+    assert len(empty) == 0
+    assert list(empty.columns) == zillow_columns
+    with pytest.raises(ValueError):
+        write_chunked_cache(iter([]), cache_file, cache_file + '.fingerprints')
+    pd.testing.assert_frame_equal(read_zillow_cache(filename = cache_file), empty)
+
+
+def test_client_join_matches_read_sql(tmp_path, monkeypatch):
+    '''
+    This function checks that reading the lookup tables and fact partitions separately
+    and joining them in memory gives the same frame as the server side join
+    '''
+    #the lookup tables are cached in the working directory
+    monkeypatch.chdir(tmp_path)
+    db = str(tmp_path / 'zillow.db')
+    joined_file = str(tmp_path / 'joined.parquet')
+    single_file = str(tmp_path / 'single.parquet')
+    make_zillow_db(db, 2500)
+    dispose_engines()
+    try:
+        get_engine('zillow', url = f'sqlite:///{db}')
+        client_join_zillow_data(zillow_columns, partitions = 3, ttl = 0, chunksize = 300, filename = joined_file,
+                                fingerprint_filename = joined_file + '.fingerprints')
+        with connect('zillow') as conn:
+            df = pd.read_sql(sqlalchemy.text(zillow_query.format(columns = zillow_select(zillow_columns))), conn)
+    finally:
+        dispose_engines()
+    write_zillow_cache(df, single_file, single_file + '.fingerprints')
+    joined = read_zillow_cache(filename = joined_file)
+    single = read_zillow_cache(filename = single_file)
+    for col in joined.select_dtypes('category'):
+        joined[col] = joined[col].astype(str)
+        single[col] = single[col].astype(str)
+    pd.testing.assert_frame_equal(joined, single)
+
+
+def test_refresh_fetches_late_and_changed_rows(tmp_path):
+    '''
+    This function checks that a refresh picks up rows that arrive late for the
+    high-water mark's day, and with check_changed rows that changed before it,
+    leaving the cache the same as a full reread
+    '''
+    db = str(tmp_path / 'zillow.db')
+    cache_file = str(tmp_path / 'zillow_df.parquet')
+    single_file = str(tmp_path / 'single.parquet')
+    make_zillow_db(db, 2500)
+    dispose_engines()
+    try:
+        get_engine('zillow', url = f'sqlite:///{db}')
+        stream_zillow_data(chunksize = 1000, filename = cache_file, fingerprint_filename = cache_file + '.fingerprints')
+        con = sqlite3.connect(db)
+        high_water_mark = con.execute('select max(transactiondate) from predictions_2017').fetchone()[0]
+        #a second sale of an older parcel reported late on the latest day, and a corrected logerror
+        con.execute('insert into predictions_2017 select max(id) + 1, min(parcelid), .5, ? from predictions_2017',
+                    (high_water_mark,))
+        con.execute('update predictions_2017 set logerror = logerror + 1 where id = 7')
+        con.commit()
+        con.close()
+        assert refresh_zillow_cache(filename = cache_file, fingerprint_filename = cache_file + '.fingerprints') > 0
+        assert len(read_zillow_cache(filename = cache_file)) == 2501
+        refresh_zillow_cache(check_changed = True, filename = cache_file,
+                             fingerprint_filename = cache_file + '.fingerprints')
+        with connect('zillow') as conn:
+            df = pd.read_sql(sqlalchemy.text(zillow_query.format(columns = zillow_select(zillow_columns))), conn)
+    finally:
+        dispose_engines()
+    write_zillow_cache(df, single_file, single_file + '.fingerprints')
+    key = ['parcelid', 'transactiondate']
+    refreshed = read_zillow_cache(filename = cache_file).sort_values(key).reset_index(drop = True)
+    single = read_zillow_cache(filename = single_file).sort_values(key).reset_index(drop = True)
+    for col in refreshed.select_dtypes('category'):
+        refreshed[col] = refreshed[col].astype(str)
+        single[col] = single[col].astype(str)
+    pd.testing.assert_frame_equal(refreshed, single, check_dtype = False)
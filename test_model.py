@@ -0,0 +1,57 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.feature_selection import SelectKBest, f_regression, RFE
+from sklearn.linear_model import LinearRegression
+
+from model import select_kbest, rfe
+
+
+def make_predictors(seed, n = 500):
+    '''
+    This function returns random predictors where a few drive the target
+    '''
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.normal(size = (n, 7)), columns = [f'x{i}' for i in range(7)])
+    X['x1'] = X.x0 * .5 + rng.normal(size = n) * .5
+    y = pd.Series(3 * X.x0 - 2 * X.x2 + X.x4 * .5 + rng.normal(size = n), name = 'error')
+    return X, y
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_select_kbest_matches_sklearn(seed):
+    '''
+    This function checks select_kbest keeps the same features as SelectKBest(f_regression)
+    for every k, with a constant column (a NaN score) and two tied columns
+    '''
+    X, y = make_predictors(seed)
+    X['constant'] = 1.
+    X['tied'] = X.x3
+    for k in list(range(1, X.shape[1] + 1)) + ['all']:
+        with warnings.catch_warnings():
+            #f_regression warns about the constant column
+            warnings.simplefilter('ignore')
+            expected = SelectKBest(f_regression, k = k).fit(X, y).get_feature_names_out().tolist()
+        assert select_kbest(X, y, k) == expected
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_rfe_matches_sklearn(seed):
+    '''
+    This function checks rfe keeps the same features as RFE(LinearRegression()) for every k
+    '''
+    X, y = make_predictors(seed)
+    for k in range(1, X.shape[1] + 1):
+        expected = RFE(LinearRegression(), n_features_to_select = k).fit(X, y).get_feature_names_out().tolist()
+        assert rfe(X, y, k) == expected
+
+
+def test_more_features_than_columns_keeps_all():
+    '''
+    This function checks asking for more features than there are keeps them all
+    '''
+    X, y = make_predictors(0)
+    assert select_kbest(X, y, X.shape[1] + 3) == list(X.columns)
+    assert rfe(X, y, X.shape[1] + 3) == list(X.columns)
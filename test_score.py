@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import explore
+import score
+from acquire import write_zillow_cache, read_zillow_cache, zillow_cache_file, zillow_fingerprint_file
+from benchmark import synthetic_zillow_data
+from model import train_cluster_models, predict_cluster_models
+from wrangle_zillow import scaled_zillow_columns
+
+
+#predictors of the scoring model, scaled columns, dummies and a new feature
+score_features = ['age_scaled', 'taxrate_scaled', 'structure_dollar_per_sqft_scaled', 'bedroomcnt_scaled',
+                  'central_heating', 'no_heating', 'los_angeles', 'orange']
+
+
+@pytest.mark.parametrize('config', [{'model': 'linear'}, {'model': 'lassolars', 'alpha': .0001}])
+def test_score_raw_records_matches_wrangled_predictions(tmp_path, monkeypatch, config):
+    '''
+    This function saves a cluster model and a scoring model trained on the wrangled splits,
+    scores the raw cache rows of validate and checks them against predict_cluster_models
+    on the wrangled validate split
+    '''
+    #the cache, stage cache and every artifact are written in the working directory
+    monkeypatch.chdir(tmp_path)
+    write_zillow_cache(synthetic_zillow_data(20000), zillow_cache_file, zillow_fingerprint_file)
+    train, validate, test, scaler = scaled_zillow_columns(return_scaler = True)
+    train_clusters, kmeans = explore.run_kmeans(4, ['calculatedfinishedsquarefeet_scaled', 'acres_scaled'],
+                                                'size_cluster', train, save_as = 'size', scaler = scaler)
+    X_train = train[score_features].copy()
+    X_train['size_cluster'] = train_clusters.size_cluster
+    cluster_models = train_cluster_models(X_train, train[['error']], 'size_cluster', config)
+    score.save_scoring_model(cluster_models, None, scaler = scaler, cluster_model = 'size')
+    scorer = score.load_scorer()
+
+    #a parcel sold twice is one raw record
+    validate = validate.drop_duplicates('parcelid').copy()
+    raw = read_zillow_cache().drop_duplicates('parcelid').set_index('parcelid', drop = False)
+    records = raw.loc[validate.parcelid.to_numpy()].to_dict('records')
+    explore.assign_clusters(validate, 'size', 'size_cluster')
+    expected = predict_cluster_models(cluster_models, validate)
+
+    predictions = score.score(records, scorer)
+    assert len(records) > 0
+    np.testing.assert_allclose(predictions, expected, rtol = 0, atol = 1e-6)
+    assert score.score(records[0], scorer) == pytest.approx(expected[0], abs = 1e-6)
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from acquire import write_zillow_cache, read_zillow_cache
+from benchmark import synthetic_zillow_data, staged_clean_zillow
+from wrangle_zillow import (fused_clean_zillow, handle_missing_values, null_finder_columns, null_finder_rows,
+                            stream_null_profile, profile_columns, profile_rows)
+
+
+@pytest.fixture
+def zillow_cache(tmp_path):
+    '''
+    This function writes synthetic rows to a parquet cache
+    and returns a function that reads them back like wrangle_zillow does
+    '''
+    filename = str(tmp_path / 'zillow_df.parquet')
+    write_zillow_cache(synthetic_zillow_data(20000), filename, filename + '.fingerprints')
+    return lambda: read_zillow_cache(filename = filename)
+
+
+def test_fused_clean_matches_staged(zillow_cache):
+    '''
+    This function checks that the fused single pass cleaning gives exactly
+    the frame the staged cleaning functions give
+    '''
+    staged = staged_clean_zillow(zillow_cache())
+    fused = fused_clean_zillow(zillow_cache(), .6, .6)
+    assert len(fused) > 0
+    pd.testing.assert_frame_equal(staged, fused)
+
+
+def test_fused_clean_matches_staged_with_unknown_county(zillow_cache):
+    '''
+    This function checks the two paths also agree when a county has no name
+    and gets its own dummy column
+    '''
+    df = zillow_cache()
+    df.loc[df.index[:500], 'fips'] = 6000
+    pd.testing.assert_frame_equal(staged_clean_zillow(df.copy()), fused_clean_zillow(df.copy(), .6, .6))
+
+
+def baseline_handle_missing_values(df, prop_required_column, prop_required_row):
+    '''
+    This function is handle_missing_values as it was before the null masks
+    '''
+    thresh_row = int(round(prop_required_column*df.shape[0],0))
+    df = df.dropna(axis=1, thresh=thresh_row)
+    thresh_col = int(round(prop_required_row*df.shape[1],0))
+    return df.dropna(axis=0, thresh=thresh_col)
+
+
+def baseline_null_finder_columns(df):
+    '''
+    This function is null_finder_columns as it was before the null masks
+    '''
+    nulls = pd.DataFrame(index = df.columns)
+    nulls['num_rows_missing'] = df.isnull().sum(axis = 0)
+    nulls['pct_rows_missing'] = nulls.num_rows_missing / df.shape[0]
+    return nulls
+
+
+def baseline_null_finder_rows(df):
+    '''
+    This function is null_finder_rows as it was before the null masks
+    '''
+    rows = pd.DataFrame()
+    rows['num_cols_missing'] = df.isnull().sum(axis=1)
+    rows['pct_cols_missing'] = df.isnull().sum(axis=1) / df.shape[1]
+    num_rows = rows.groupby('num_cols_missing').count()
+    num_rows = num_rows.rename(columns ={'pct_cols_missing': "num_rows"})
+    pct_cols = rows.groupby('num_cols_missing').mean()
+    return pd.concat([pct_cols, num_rows], axis=1, sort=False).reset_index()
+
+
+def random_nulls(seed, rows = 3000, columns = 11):
+    '''
+    This function returns a df with a different share of nulls in every column,
+    a column count that does not fill whole bytes and a few all null rows
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.random((rows, columns)), columns = [f'c{i}' for i in range(columns)])
+    df = df.mask(rng.random((rows, columns)) < np.linspace(0, .9, columns))
+    df.iloc[:5] = np.nan
+    df['name'] = np.where(rng.random(rows) < .3, None, 'x')
+    return df
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+@pytest.mark.parametrize('prop_required', [(.6, .6), (.3, .8), (.9, .2)])
+def test_handle_missing_values_matches_baseline(seed, prop_required):
+    '''
+    This function checks the null mask handle_missing_values keeps
+    the same columns and rows as two dropna calls
+    '''
+    df = random_nulls(seed)
+    pd.testing.assert_frame_equal(handle_missing_values(df.copy(), *prop_required),
+                                  baseline_handle_missing_values(df.copy(), *prop_required))
+
+
+def test_null_finders_match_baseline(zillow_cache):
+    '''
+    This function checks null_finder_columns and null_finder_rows
+    against isnull sums and groupby
+    '''
+    for df in [random_nulls(2), zillow_cache()]:
+        pd.testing.assert_frame_equal(null_finder_columns(df), baseline_null_finder_columns(df))
+        pd.testing.assert_frame_equal(null_finder_rows(df), baseline_null_finder_rows(df))
+
+
+def test_stream_null_profile_matches_baseline(tmp_path):
+    '''
+    This function checks that profiling a parquet cache in batches
+    gives the same null tables as the whole frame
+    '''
+    filename = str(tmp_path / 'zillow_df.parquet')
+    write_zillow_cache(synthetic_zillow_data(20000), filename, filename + '.fingerprints')
+    df = read_zillow_cache(filename = filename)
+    profile = stream_null_profile([filename], batch_size = 3000)
+    pd.testing.assert_frame_equal(profile_columns(profile), baseline_null_finder_columns(df))
+    pd.testing.assert_frame_equal(profile_rows(profile), baseline_null_finder_rows(df))
@@ -0,0 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor
+
+
+#data every task of a worker_pool shares, by name, sent to each worker process once
+worker_data = {}
+
+
+################################# Worker Pool Functions #################################
+
+def set_worker_data(data):
+    '''
+    This function stores a dict of shared data in this process's worker_data,
+    it runs once in every worker_pool process and can be called directly
+    to run the same tasks without a pool
+    '''
+    worker_data.update(data)
+
+
+def worker_pool(workers = None, **data):
+    '''
+    This function returns a ProcessPoolExecutor that hands data (name=value) to each
+    worker process once instead of with every task, tasks read it from worker_data[name]
+    '''
+    return ProcessPoolExecutor(max_workers = workers, initializer = set_worker_data, initargs = (data,))
@@ -1,88 +1,139 @@
 import pandas as pd
+import numpy as np
+import os
+import json
+import pickle
+import hashlib
+import shutil
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from scipy.spatial import cKDTree
 
 from sklearn.model_selection import train_test_split
-import sklearn.preprocessing
 
-from acquire import get_zillow_data
+from acquire import get_zillow_data, zillow_columns, zillow_cache_file, cache_fingerprint
+from scaling import fit_scaler, merge_scalers, scale_columns, save_scaler, load_scaler, scaler_artifact_file
+from zillow_features import (null_fill_values, heating_fill_value, bedroom_bounds, bathroom_bounds,
+                             square_feet_bounds, heating_outliers, max_acres, max_taxrate,
+                             feature_year, square_feet_per_acre, county_names, heating_names, new_features)
+from instrument import instrumented
 
 
+#unitcnt is all the same after cleaning, the rest are unnecessary
+unneeded_columns = ['propertylandusetypeid', 'propertycountylandusecode', 'propertylandusedesc',
+                    'calculatedbathnbr', 'finishedsquarefeet12', 'heatingorsystemtypeid', 
+                    'id', 'fips', 'fullbathcnt', 'propertyzoningdesc', 'unitcnt',
+                    'regionidcounty', 'id.1', 'assessmentyear', 
+                    'censustractandblock', 'rawcensustractandblock', 'buildingqualitytypeid']
+#columns create_features replaces with new features
+feature_source_columns = ['bathroomcnt', 'taxamount', 'taxvaluedollarcnt', 
+                          'structuretaxvaluedollarcnt', 'landtaxvaluedollarcnt', 
+                          'yearbuilt', 'lotsizesquarefeet', 'logerror']
+#proportion of non-null values required to keep a column and a row
+prop_required_column = .6
+prop_required_row = .6
+#random_state used for every split
+split_random_state = 123
+#numeric columns scaled_zillow_columns scales
+columns_to_scale = ['bedroomcnt', 'calculatedfinishedsquarefeet', 'fireplacecnt', 'latitude', 'longitude', 'poolcnt', 'regionidcity', 'regionidzip', 'roomcnt', 'age', 'taxrate', 'acres', 'structure_dollar_per_sqft', 'land_dollar_per_sqft', 'bed_bath_ratio']
+#km per degree of latitude, and of longitude at the middle of the three counties
+km_per_degree_latitude = 110.9
+km_per_degree_longitude = 110.9 * np.cos(np.radians(34))
 
-def wrangle_zillow(cached=True):
+#where wrangle_zillow and scaled_zillow_columns save their outputs
+stage_cache_dir = 'zillow_stages'
+#the least recently used outputs are removed once the stage cache is bigger than this
+stage_cache_max_bytes = 2**30
+#bump this when a stage's code changes so old outputs are not reused
+stage_version = 3
+
+
+@instrumented
+def wrangle_zillow(cached=True, fused=False):
     '''
     This function prepares the data for exploration by 
     handling null values and outliers,
     creating new features from existing features,
-    and splitting the data into train, validate and test
+    and splitting the data into train, validate and test.
+    If cached == True and this data has been wrangled before with the same settings
+    the saved splits are returned, cached == False refetches the data and wrangles it again.
+    fused=True runs the same cleaning as one pass with fused_clean_zillow
     '''
+    if cached and os.path.isfile(zillow_cache_file):
+        splits = load_stage(stage_key('wrangle', wrangle_params()))
+        if splits is not None:
+            return splits
     #get zillow data
-    df = get_zillow_data()
-    #filling nulls with appropriate values
-    df = fill_nulls(df)
-    #removing outliers from data
-    df = remove_outliers(df)
-    #creating new features
-    df = create_features(df)
-    #filter out columns and rows with more than 40% null values
-    df = handle_missing_values(df, .6, .6)
-    #dropping unitcnt since they are all the same and unnecessary columns
-    df = df.drop(columns = ['propertylandusetypeid', 'propertycountylandusecode', 'propertylandusedesc',
-                             'calculatedbathnbr', 'finishedsquarefeet12', 'heatingorsystemtypeid', 
-                            'id', 'fips', 'fullbathcnt', 'propertyzoningdesc', 'unitcnt',
-                            'regionidcounty', 'id.1', 'assessmentyear', 
-                            'censustractandblock', 'rawcensustractandblock', 'buildingqualitytypeid'])
-    #drop all rows with missing values
-    df.dropna(inplace = True)
+    df = get_zillow_data(cached = cached, columns = zillow_columns)
+    if fused:
+        df = fused_clean_zillow(df, prop_required_column, prop_required_row)
+    else:
+        #filling nulls with appropriate values
+        df = fill_nulls(df)
+        #removing outliers from data
+        df = remove_outliers(df)
+        #creating new features
+        df = create_features(df)
+        #filter out columns and rows with more than 40% null values
+        df = handle_missing_values(df, prop_required_column, prop_required_row)
+        #dropping unitcnt since they are all the same and unnecessary columns
+        df = df.drop(columns = unneeded_columns)
+        #drop all rows with missing values
+        df.dropna(inplace = True)
     #split into train, validate, test
     train, validate, test = zillow_split(df)
+    save_stage(stage_key('wrangle', wrangle_params()), (train, validate, test))
     return train, validate, test
 
 
 
+@instrumented
 def fill_nulls(df):
     '''
     This function fill nulls with appropriate values
     '''
-    df.poolcnt = df.poolcnt.fillna(0)
-    df.fireplacecnt = df.fireplacecnt.fillna(0)
-    df.heatingorsystemdesc = df.heatingorsystemdesc.fillna('None')
-    df.unitcnt = df.unitcnt.fillna(1)
+    df.poolcnt = df.poolcnt.fillna(null_fill_values['poolcnt'])
+    df.fireplacecnt = df.fireplacecnt.fillna(null_fill_values['fireplacecnt'])
+    #the cache stores this as a categorical, go back to strings before filling
+    df.heatingorsystemdesc = df.heatingorsystemdesc.astype(object).fillna(heating_fill_value)
+    df.unitcnt = df.unitcnt.fillna(null_fill_values['unitcnt'])
     return df
 
+@instrumented
 def remove_outliers(df):
     '''
     This function removes outliers and 
     '''
     #filter out bedrooms and bathrooms == 0
-    df = df[(df.bedroomcnt > 0) & (df.bedroomcnt <= 7) & (df.bathroomcnt > 0) & (df.bathroomcnt <= 7)]
+    df = df[(df.bedroomcnt > bedroom_bounds[0]) & (df.bedroomcnt <= bedroom_bounds[1])
+            & (df.bathroomcnt > bathroom_bounds[0]) & (df.bathroomcnt <= bathroom_bounds[1])]
     #filter out houses less than 400 square feet
-    df = df[(df.calculatedfinishedsquarefeet > 400) & (df.calculatedfinishedsquarefeet < 7000)]
+    df = df[(df.calculatedfinishedsquarefeet > square_feet_bounds[0])
+            & (df.calculatedfinishedsquarefeet < square_feet_bounds[1])]
     #filter out all units not equal to 1
     df = df[df.unitcnt == 1]
     #removing heating or system source outliers
-    df = df[~df.heatingorsystemdesc.isin(['Yes', 'Gravity', 'Radiant', 'Baseboard', 'Solar', 'Forced air'])]
+    df = df[~df.heatingorsystemdesc.isin(heating_outliers)]
     return df
 
 
+@instrumented
 def create_features(df):
     '''
     This functions creates new features that are more 
     apllicable and familiar out of existing features
     '''
-    df['age'] = 2017 - df.yearbuilt
-    # create taxrate variable
-    df['taxrate'] = df.taxamount/df.taxvaluedollarcnt
-    # create acres variable
-    df['acres'] = df.lotsizesquarefeet/43560
-    # dollar per square foot-structure
-    df['structure_dollar_per_sqft'] = df.structuretaxvaluedollarcnt/df.calculatedfinishedsquarefeet
-    # dollar per square foot-land
-    df['land_dollar_per_sqft'] = df.landtaxvaluedollarcnt/df.lotsizesquarefeet
-    # ratio of beds to baths
-    df['bed_bath_ratio'] = df.bedroomcnt/df.bathroomcnt
+    # age, taxrate, acres, dollar per square foot of structure and land, ratio of beds to baths
+    # computed in float64 whatever the cache stores the inputs as
+    for col, feature in new_features.items():
+        df[col] = feature(lambda c: df[c].astype('float64'))
     #changing numbered labels into appropriate names
-    df['county'] = df.fips.replace([6037, 6059, 6111],['los_angeles', 'orange', 'ventura'])
+    df['county'] = df.fips.replace(list(county_names), list(county_names.values()))
     #changing names of heating system
-    df.heatingorsystemdesc = df.heatingorsystemdesc.replace(['Central', 'Floor/Wall', 'None'], ['central_heating', 'floor_wall_heating', 'no_heating'])
+    df.heatingorsystemdesc = df.heatingorsystemdesc.replace(list(heating_names), list(heating_names.values()))
     #creating dummy variables
     county_df = pd.get_dummies(df.county)
     heating_or_system_df = pd.get_dummies(df.heatingorsystemdesc)
@@ -91,92 +142,638 @@ def create_features(df):
     #duplicating logerror so it will be at the end of the list
     df['error'] = df.logerror
     #filter out outliers on new features
-    df = df[(df.acres < 10) & (df.taxrate < .05)]
+    df = df[(df.acres < max_acres) & (df.taxrate < max_taxrate)]
     #drop duplicate columns
-    df = df.drop(columns = ['bathroomcnt', 'taxamount', 'taxvaluedollarcnt', 
-                       'structuretaxvaluedollarcnt', 'landtaxvaluedollarcnt', 
-                       'yearbuilt', 'lotsizesquarefeet', 'logerror'])
+    df = df.drop(columns = feature_source_columns)
     return df
 
 
+@instrumented
 def handle_missing_values(df, prop_required_column, prop_required_row):
     '''
     This function takes in a Dataframe, 
     proportion(0-1) of nulls required for a column
     and a proportion(0-1) of nulls required for rows
     then returns a dataframe without the nulls 
-    under the threshold
+    under the threshold.
+    The nulls are found with one scan into a bit-packed mask
+    that both decisions are made from
     '''
-    #setting threshold for row, only accepts integer
-    thresh_row = int(round(prop_required_column*df.shape[0],0))
-    #dropping nulls under threshold
-    df.dropna(axis=1, thresh=thresh_row, inplace=True)
-    #setting threshold for columns, only accepts integer
-    thresh_col = int(round(prop_required_row*df.shape[1],0))
-    #dropping nulls under threshold
-    df.dropna(axis=0, thresh=thresh_col, inplace=True)
-    return df 
+    mask = null_mask(df)
+    #columns and row threshold from the column null counts
+    columns, thresh_col = missing_value_plan(profile_mask(mask, df.columns), prop_required_column, prop_required_row)
+    #nulls of each row in the kept columns
+    kept = np.packbits(df.columns.isin(columns))
+    row_nulls = bit_counts[mask & kept].sum(axis = 1, dtype = np.int64)
+    #dropping rows with fewer non-nulls than the threshold
+    return df.loc[row_nulls <= len(columns) - thresh_col, columns]
+
 
+################################# Fused Cleaning Function #################################
+
+@instrumented
+def fused_clean_zillow(df, prop_required_column, prop_required_row):
+    '''
+    This function gives the same result as running fill_nulls, remove_outliers,
+    create_features, handle_missing_values, dropping unneeded_columns and dropna,
+    but every row filter is combined into one mask first, the new features
+    are only computed for the rows that pass it and the result
+    is only built once, for the rows and columns that are kept
+    '''
+    values = lambda col: df[col].to_numpy()
+    #fill_nulls, only the heating column needs its filled values to filter on
+    heating = df.heatingorsystemdesc.astype(object).fillna(heating_fill_value)
+    unitcnt = df.unitcnt.fillna(null_fill_values['unitcnt']).to_numpy()
+    #remove_outliers
+    with np.errstate(invalid = 'ignore'):
+        keep = ((values('bedroomcnt') > bedroom_bounds[0]) & (values('bedroomcnt') <= bedroom_bounds[1])
+                & (values('bathroomcnt') > bathroom_bounds[0]) & (values('bathroomcnt') <= bathroom_bounds[1])
+                & (values('calculatedfinishedsquarefeet') > square_feet_bounds[0])
+                & (values('calculatedfinishedsquarefeet') < square_feet_bounds[1])
+                & (unitcnt == 1) & ~heating.isin(heating_outliers).to_numpy())
+    #the dummy columns are made before create_features filters on acres and taxrate
+    county = df.fips[keep].replace(list(county_names), list(county_names.values()))
+    heating_kept = heating[keep].replace(list(heating_names), list(heating_names.values()))
+    county_dummy_names = pd.Categorical(county).categories
+    heating_dummy_names = pd.Categorical(heating_kept).categories
+    #create_features filters, checked on every row without making the features,
+    #in float64 like create_features
+    outliers_removed = keep
+    float_values = lambda col: df[col].to_numpy(dtype = np.float64, na_value = np.nan)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        keep = (keep & (new_features['acres'](float_values) < max_acres)
+                & (new_features['taxrate'](float_values) < max_taxrate))
+    rows = np.flatnonzero(keep)
+    pick = lambda col: float_values(col)[rows]
+    #new features, only for the surviving rows
+    columns = {}
+    for col in df.columns:
+        if col not in feature_source_columns:
+            columns[col] = None
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for col, feature in new_features.items():
+            columns[col] = feature(pick)
+    county = county[keep[outliers_removed]]
+    heating_kept = heating_kept[keep[outliers_removed]]
+    columns['county'] = county.array
+    for names, categories in [(county, county_dummy_names), (heating_kept, heating_dummy_names)]:
+        dummies = pd.get_dummies(pd.Categorical(names, categories = categories))
+        for col in dummies.columns:
+            columns[col] = dummies[col].to_numpy()
+    columns['error'] = values('logerror')[rows]
+    #raw columns keep their dtype, filled columns count as having no nulls
+    notnull = {}
+    for col, col_values in columns.items():
+        if col == 'heatingorsystemdesc' or col in null_fill_values:
+            notnull[col] = np.ones(len(rows), dtype = bool)
+        elif col_values is None:
+            notnull[col] = df[col].notnull().to_numpy()[rows]
+        else:
+            notnull[col] = ~pd.isnull(col_values)
+    #handle_missing_values
+    thresh_row = int(round(prop_required_column*len(rows),0))
+    kept_columns = [col for col in columns if notnull[col].sum() >= thresh_row]
+    thresh_col = int(round(prop_required_row*len(kept_columns),0))
+    row_counts = np.zeros(len(rows), dtype = 'int32')
+    for col in kept_columns:
+        row_counts += notnull[col]
+    final = row_counts >= thresh_col
+    #drop unneeded_columns and then any row with a null
+    missing = [col for col in unneeded_columns if col not in kept_columns]
+    if missing:
+        raise KeyError(f'{missing} not found in axis')
+    final_columns = [col for col in kept_columns if col not in unneeded_columns]
+    for col in final_columns:
+        final &= notnull[col]
+    final_rows = rows[final]
+    index = df.index[final_rows]
+    result = {}
+    for col in final_columns:
+        if col == 'heatingorsystemdesc':
+            col_values = heating_kept.array[final]
+        elif col in null_fill_values:
+            col_values = df[col].take(final_rows).fillna(null_fill_values[col]).array
+        elif columns[col] is None:
+            col_values = df[col].take(final_rows).array
+        else:
+            col_values = columns[col][final]
+        #keep each column's dtype as is instead of letting pandas infer one
+        result[col] = pd.Series(col_values, index = index, dtype = col_values.dtype, copy = False)
+    return pd.DataFrame(result, index = index)
 
 
+
+@instrumented
 def zillow_split(df):
     '''
     This function splits a dataframe into train, validate, and test sets
     '''
-    train_and_validate, test = train_test_split(df, train_size=.8, random_state=123)
-    train, validate = train_test_split(train_and_validate, train_size = .7, random_state=123)
+    train_and_validate, test = train_test_split(df, train_size=.8, random_state=split_random_state)
+    train, validate = train_test_split(train_and_validate, train_size = .7, random_state=split_random_state)
     return train, validate, test
 
-def scaled_zillow_columns(cached = True):
+@instrumented
+def scaled_zillow_columns(cached = True, return_scaler = False, chunksize = 100000):
     '''
     This function uses a MinMaxScaler to scale numeric columns
-    from the wrangle_zillow function
-    '''
-    train, validate, test = wrangle_zillow()
-    columns_to_scale= ['bedroomcnt', 'calculatedfinishedsquarefeet', 'fireplacecnt', 'latitude', 'longitude', 'poolcnt', 'regionidcity', 'regionidzip', 'roomcnt', 'age', 'taxrate', 'acres', 'structure_dollar_per_sqft', 'land_dollar_per_sqft', 'bed_bath_ratio']
-    #initialize scaler function
-    scaler = sklearn.preprocessing.MinMaxScaler()
-    #adds '_scaled' to columns that will be scaled
-    new_column_names = [c + '_scaled' for c in columns_to_scale]
+    from the wrangle_zillow function.
+    The scaler is fit on train chunksize rows at a time and saved to scaler_artifact_file
+    so new data can be scaled with load_scaler and scale_columns.
+    If cached == True and these splits have been scaled before with the same settings
+    the saved splits are returned, cached == False refetches and rebuilds everything.
+    return_scaler=True also returns the fitted scaler
+    '''
+    if cached and os.path.isfile(zillow_cache_file):
+        scaled = load_stage(stage_key('scaled', scaled_params()))
+        if scaled is not None:
+            return scaled if return_scaler else scaled[:3]
+    train, validate, test = wrangle_zillow(cached)
     #fitting columns to be scaled
-    scaler.fit(train[columns_to_scale])
-    #adding scaled columns back into their respective dataframes
-    train = pd.concat([
-        train,
-        pd.DataFrame(scaler.transform(train[columns_to_scale]), columns=new_column_names, index=train.index),
-    ], axis=1)
-    validate = pd.concat([
-        validate,
-        pd.DataFrame(scaler.transform(validate[columns_to_scale]), columns=new_column_names, index=validate.index),
-    ], axis=1)
-    test = pd.concat([
-        test,
-        pd.DataFrame(scaler.transform(test[columns_to_scale]), columns=new_column_names, index=test.index),
-    ], axis=1)
-    
-    train = train.drop(columns = columns_to_scale)
-    validate= validate.drop(columns = columns_to_scale)
-    test = test.drop(columns = columns_to_scale)
+    scaler = fit_scaler(train[columns_to_scale].iloc[i:i + chunksize] for i in range(0, len(train), chunksize))
+    save_scaler(scaler, params = scaled_params())
+    #replacing the columns with their '_scaled' versions
+    train = scale_columns(train, scaler)
+    validate = scale_columns(validate, scaler)
+    test = scale_columns(test, scaler)
     
+    save_stage(stage_key('scaled', scaled_params()), (train, validate, test, scaler))
+    if return_scaler:
+        return train, validate, test, scaler
     return train, validate, test
 
 
+################################# Spatial Index Functions #################################
+
+def project_coordinates(df):
+    '''
+    This function turns the latitude and longitude columns (millionths of a degree)
+    into an array of x and y in km, close enough to true distances across the three counties
+    '''
+    return np.column_stack([df.longitude.to_numpy(dtype = np.float64) / 1e6 * km_per_degree_longitude,
+                            df.latitude.to_numpy(dtype = np.float64) / 1e6 * km_per_degree_latitude])
+
+
+def build_spatial_index(df):
+    '''
+    This function builds a KD-tree over the parcels of df,
+    returns a dict with the tree and the df's index labels and parcelids in tree order
+    '''
+    return {'tree': cKDTree(project_coordinates(df)),
+            'index': df.index.to_numpy(),
+            'parcelid': df.parcelid.to_numpy()}
+
+
+def get_spatial_index(df, cached = True):
+    '''
+    This function returns the spatial index of df's parcels, saved in the stage cache
+    by a hash of their parcelids and coordinates so it is only built once
+    '''
+    parcels = pd.util.hash_pandas_object(df[['parcelid', 'latitude', 'longitude']]).to_numpy()
+    #the parcels are the data, so this works for any df even without the zillow cache
+    key = stage_key('spatial_index', {}, data = hashlib.sha256(parcels.tobytes()).hexdigest())
+    if cached:
+        index = load_stage(key)
+        if index is not None:
+            return index
+    index = build_spatial_index(df)
+    save_stage(key, index)
+    return index
+
+
+def nearest_parcels(index, df, k = 10, exclude_self = False):
+    '''
+    This function finds the k nearest indexed parcels of every row of df at once,
+    returns the distances in km and the positions in the index (n rows by k).
+    exclude_self=True skips each row's own parcel when df is the indexed df
+    '''
+    distances, positions = index['tree'].query(project_coordinates(df), k = k + exclude_self, workers = -1)
+    distances, positions = distances.reshape(len(df), -1), positions.reshape(len(df), -1)
+    if exclude_self:
+        #the parcel itself is usually first, but not when another parcel is at the same spot
+        keep = positions != index_positions(index, df)[:, None]
+        #rows that did not find themselves drop their furthest neighbour instead
+        keep[keep.all(axis = 1), -1] = False
+        distances = distances[keep].reshape(len(df), k)
+        positions = positions[keep].reshape(len(df), k)
+    return distances, positions
+
+
+def index_positions(index, df):
+    '''
+    This function returns the position in the index of every row of df, -1 if it is not indexed
+    '''
+    lookup = pd.Series(np.arange(len(index['index'])), index = index['index'])
+    return lookup.reindex(df.index).fillna(-1).to_numpy(dtype = np.int64)
+
+
+def parcels_within(index, df, radius_km):
+    '''
+    This function finds every indexed parcel within radius_km of each row of df at once,
+    returns a list with an array of index positions per row
+    '''
+    return index['tree'].query_ball_point(project_coordinates(df), r = radius_km, workers = -1)
+
+
+def nearest_clusters(index, clusters, df, k = 10):
+    '''
+    This function returns the most common cluster among the k nearest indexed parcels
+    of every row of df, clusters holds the cluster of each indexed parcel in index order
+    '''
+    codes, labels = pd.factorize(np.asarray(clusters))
+    neighbours = codes[nearest_parcels(index, df, k)[1]]
+    counts = np.zeros((len(df), len(labels)), dtype = np.int64)
+    np.add.at(counts, (np.repeat(np.arange(len(df)), k), neighbours.ravel()), 1)
+    return pd.Series(np.asarray(labels)[counts.argmax(axis = 1)], index = df.index)
+
+
+def add_neighborhood_features(train, validate, test, k = 10, cached = True):
+    '''
+    This function adds neighbourhood features to the splits from the k nearest train parcels:
+    neighbor_dollar_per_sqft, the median structure_dollar_per_sqft, 
+    neighbor_error, the mean logerror, and neighbor_km, the distance to the kth one.
+    Only train parcels are indexed and a train row never counts itself,
+    so no split sees logerrors it should not
+    '''
+    index = get_spatial_index(train, cached)
+    dollar_per_sqft = train.structure_dollar_per_sqft.to_numpy(dtype = np.float64)
+    error = train.error.to_numpy(dtype = np.float64)
+    splits = []
+    for df in [train, validate, test]:
+        distances, positions = nearest_parcels(index, df, k, exclude_self = df is train)
+        df = df.copy()
+        df['neighbor_dollar_per_sqft'] = np.nanmedian(dollar_per_sqft[positions], axis = 1)
+        df['neighbor_error'] = np.nanmean(error[positions], axis = 1)
+        df['neighbor_km'] = distances[:, -1]
+        splits.append(df)
+    return tuple(splits)
+
+
+################################# Stage Cache Functions #################################
+
+def wrangle_params():
+    '''
+    This function returns every setting that changes wrangle_zillow's output,
+    so editing any cleaning threshold or name map invalidates the saved splits.
+    The new_features formulas are code, bump stage_version when one changes
+    '''
+    return {'columns': zillow_columns,
+            'unneeded_columns': unneeded_columns,
+            'null_fill_values': null_fill_values,
+            'heating_fill_value': heating_fill_value,
+            'bounds': {'bedroom': bedroom_bounds, 'bathroom': bathroom_bounds, 'square_feet': square_feet_bounds},
+            'heating_outliers': heating_outliers,
+            'new_features': list(new_features),
+            'feature_year': feature_year,
+            'square_feet_per_acre': square_feet_per_acre,
+            'max_acres': max_acres,
+            'max_taxrate': max_taxrate,
+            'county_names': county_names,
+            'heating_names': heating_names,
+            'feature_source_columns': feature_source_columns,
+            'prop_required': [prop_required_column, prop_required_row],
+            'random_state': split_random_state}
+
+
+def scaled_params():
+    '''
+    This function returns every setting that changes scaled_zillow_columns' output
+    '''
+    return {'wrangle': wrangle_params(), 'columns_to_scale': columns_to_scale}
+
+
+def stage_key(stage, params, data = None):
+    '''
+    This function hashes the stage name, stage_version, a fingerprint of the data
+    and the stage's settings into the name its output is saved under.
+    data is the cached data's fingerprint unless the stage passes its own
+    '''
+    if data is None:
+        data = cache_fingerprint()
+    payload = json.dumps({'stage': stage, 'version': stage_version,
+                          'data': data, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_stage(key):
+    '''
+    This function returns the saved output for key, or None if there is none,
+    and marks it as recently used
+    '''
+    filename = os.path.join(stage_cache_dir, f'{key}.pkl')
+    if not os.path.isfile(filename):
+        return None
+    os.utime(filename)
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_stage(key, value):
+    '''
+    This function saves a stage's output under key and then
+    evicts the least recently used outputs if the stage cache is too big
+    '''
+    os.makedirs(stage_cache_dir, exist_ok = True)
+    filename = os.path.join(stage_cache_dir, f'{key}.pkl')
+    #write to a temporary file first so a reader never sees half a file
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+    evict_stages()
+
+
+def evict_stages(max_bytes = None):
+    '''
+    This function removes the least recently used saved outputs
+    until the stage cache is no bigger than max_bytes (stage_cache_max_bytes by default)
+    '''
+    if max_bytes is None:
+        max_bytes = stage_cache_max_bytes
+    if not os.path.isdir(stage_cache_dir):
+        return
+    entries = [os.path.join(stage_cache_dir, f) for f in os.listdir(stage_cache_dir) if f.endswith('.pkl')]
+    entries.sort(key = os.path.getmtime)
+    total = sum(os.path.getsize(f) for f in entries)
+    for filename in entries:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(filename)
+        os.remove(filename)
+
+
+def clear_stage_cache():
+    '''
+    This function removes every saved stage output
+    '''
+    evict_stages(max_bytes = 0)
+
+
+################################# Partitioned Wrangle Functions #################################
+
+#the new feature columns create_features adds before its dummy columns
+new_feature_columns = ['age', 'taxrate', 'acres', 'structure_dollar_per_sqft', 
+                       'land_dollar_per_sqft', 'bed_bath_ratio', 'county']
+#split proportions matching zillow_split: 20% test, then 30% of the rest validate
+split_bounds = {'test': .2, 'validate': .2 + .8 * .3}
+#most rows partitioned_wrangle_zillow writes to one file, and most partitions (open files) one write can have
+partition_rows_per_file = 1000000
+partition_open_files = 4096
+
+
+def iter_zillow_batches(filenames, batch_size, columns = None):
+    '''
+    This function yields one or more parquet caches as dfs of at most batch_size rows,
+    only reading the given columns that each cache has if columns is given
+    '''
+    for filename in filenames:
+        parquet_file = pq.ParquetFile(filename)
+        names = parquet_file.schema_arrow.names
+        if columns is not None:
+            names = [c for c in names if c in set(columns)]
+        for batch in parquet_file.iter_batches(batch_size = batch_size, columns = names):
+            yield batch.to_pandas()
+
+
+def imap_batches(func, batches, workers, *args):
+    '''
+    This function runs func(batch, *args) for every batch across a process pool,
+    only keeping a few batches in flight at a time so memory stays bounded,
+    and yields the results in batch order as they finish
+    '''
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        pending = []
+        for i, batch in enumerate(batches):
+            pending.append(pool.submit(func, batch, i, *args))
+            if len(pending) >= 2 * (workers or os.cpu_count()):
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def map_batches(func, batches, workers, *args):
+    '''
+    This function returns the results of imap_batches as a list
+    '''
+    return list(imap_batches(func, batches, workers, *args))
+
+
+def clean_batch(df):
+    '''
+    This function runs fill_nulls, remove_outliers and create_features on one batch
+    '''
+    return create_features(remove_outliers(fill_nulls(df)))
+
+
+def batch_null_counts(df, i):
+    '''
+    This function cleans one batch and returns its row count, its columns in order,
+    the non-null count of each column and the names of its dummy columns
+    '''
+    df = clean_batch(df)
+    base_columns = [c for c in zillow_columns if c not in feature_source_columns] + new_feature_columns
+    dummies = [c for c in df.columns if c not in base_columns and c != 'error']
+    profile = null_profile([df])
+    return len(df), list(df.columns), dict(zip(df.columns, profile['rows'] - profile['column_nulls'])), dummies
+
+
+def batch_split(df, columns, dummy_dtype, thresh_col, partition_column):
+    '''
+    This function cleans one batch with the global column list and row threshold,
+    drops unneeded_columns and nulls and assigns every row to train, validate or test
+    by hashing its parcelid and transactiondate.
+    Returns the cleaned batch, each row's split and each row's partition_column value
+    '''
+    partition = df[partition_column]
+    df = clean_batch(df)
+    #dummy columns for values that are not in this batch are all zero
+    for col in columns:
+        if col not in df.columns:
+            df[col] = np.zeros(len(df), dtype = dummy_dtype)
+    df = df[columns]
+    df = df.dropna(axis = 0, thresh = thresh_col)
+    df = df.drop(columns = [c for c in unneeded_columns if c in df.columns]).dropna()
+    #a row lands in the same split however the data is partitioned
+    position = pd.util.hash_pandas_object(df[['parcelid', 'transactiondate']], index = False).to_numpy() % 10000 / 10000
+    split = np.where(position < split_bounds['test'], 'test',
+                     np.where(position < split_bounds['validate'], 'validate', 'train'))
+    return df, split, partition.loc[df.index]
+
+
+def batch_scaler(df, i, columns, dummy_dtype, thresh_col, partition_column):
+    '''
+    This function returns a scaler fit on one batch's train rows
+    '''
+    df, split, _ = batch_split(df, columns, dummy_dtype, thresh_col, partition_column)
+    return fit_scaler([df.loc[split == 'train', columns_to_scale]])
+
+
+def batch_table(df, i, columns, dummy_dtype, thresh_col, partition_column, scaler):
+    '''
+    This function cleans, splits and scales one batch like scaled_zillow_columns
+    and returns it as an arrow table with its split and partition_column
+    for partitioned_wrangle_zillow to write
+    '''
+    df, split, partition = batch_split(df, columns, dummy_dtype, thresh_col, partition_column)
+    df = scale_columns(df, scaler)
+    #whole number partition values are written as ints, so the directories are fips=6037 not fips=6037.0
+    if pd.api.types.is_float_dtype(partition) and (partition.dropna() % 1 == 0).all():
+        partition = partition.astype('Int64')
+    #added after the pandas metadata is made, they only live in the directory names
+    table = pa.Table.from_pandas(df)
+    table = table.append_column('split', pa.array(split))
+    return table.append_column(partition_column, pa.array(partition))
+
+
+@instrumented
+def partitioned_wrangle_zillow(filenames = None, output_dir = 'zillow_partitions',
+                               partition_column = 'fips', batch_size = 100000, workers = None):
+    '''
+    This function runs wrangle_zillow and scaled_zillow_columns out of core,
+    so one or more caches of any size can be wrangled with memory bounded by batch_size.
+    The first streaming pass cleans every batch across a process pool to count nulls,
+    which fixes the columns and the row threshold handle_missing_values would pick.
+    The second pass cleans each batch again, drops columns and rows with those thresholds,
+    splits the rows by a hash of parcelid and transactiondate (the same proportions as
+    zillow_split, but not the same rows) and merges the train min and max into one MinMaxScaler,
+    which is saved to output_dir with save_scaler.
+    The last pass cleans, splits and scales every batch once more and streams them into one
+    dataset write, partitioned by split and partition_column ('fips' or 'regionidzip'),
+    so each partition gets one file of up to partition_rows_per_file rows however many batches there are.
+    filenames defaults to the zillow cache.
+    Returns the scaler, read the splits back with read_partitioned_split.
+    '''
+    if filenames is None:
+        filenames = [zillow_cache_file]
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    #first pass, global null counts and dummy columns
+    rows = 0
+    columns = []
+    dummies = set()
+    notnull = {}
+    for batch_rows, batch_columns, batch_notnull, batch_dummies in map_batches(
+            batch_null_counts, iter_zillow_batches(filenames, batch_size, zillow_columns), workers):
+        rows += batch_rows
+        columns += [c for c in batch_columns if c not in columns and c not in batch_dummies and c != 'error']
+        dummies |= set(batch_dummies)
+        for col, count in batch_notnull.items():
+            notnull[col] = notnull.get(col, 0) + count
+    #dummy columns are never null, once a batch has them every row counts
+    columns += sorted(dummies, key = str) + ['error']
+    for col in dummies:
+        notnull[col] = rows
+    thresh_row = int(round(prop_required_column*rows,0))
+    columns = [col for col in columns if notnull[col] >= thresh_row]
+    thresh_col = int(round(prop_required_row*len(columns),0))
+    dummy_dtype = pd.get_dummies(pd.Series(['x'])).dtypes.iloc[0]
+    #second pass, merge the scalers fit on each batch's train rows
+    split_args = (columns, dummy_dtype, thresh_col, partition_column)
+    scaler = merge_scalers(map_batches(batch_scaler, iter_zillow_batches(filenames, batch_size, zillow_columns),
+                                       workers, *split_args))
+    #last pass, write every batch scaled, the writer keeps one open file per partition
+    tables = imap_batches(batch_table, iter_zillow_batches(filenames, batch_size, zillow_columns),
+                          workers, *split_args, scaler)
+    first = next(tables, None)
+    if first is not None:
+        #a batch can infer a different type for a column, e.g. all null, so every batch is cast to the first one's
+        batches = itertools.chain(first.to_batches(),
+                                  (batch for table in tables for batch in table.cast(first.schema).to_batches()))
+        ds.write_dataset(batches, output_dir, schema = first.schema, format = 'parquet',
+                         partitioning = ds.partitioning(pa.schema([first.schema.field('split'),
+                                                                   first.schema.field(partition_column)]),
+                                                        flavor = 'hive'),
+                         basename_template = 'part-{i}.parquet', max_rows_per_file = partition_rows_per_file,
+                         max_rows_per_group = min(partition_rows_per_file, 1 << 20),
+                         max_open_files = partition_open_files, max_partitions = partition_open_files,
+                         existing_data_behavior = 'overwrite_or_ignore')
+    os.makedirs(output_dir, exist_ok = True)
+    save_scaler(scaler, os.path.join(output_dir, scaler_artifact_file))
+    return scaler
+
+
+def read_partitioned_split(split, output_dir = 'zillow_partitions', filters = None):
+    '''
+    This function reads one split written by partitioned_wrangle_zillow,
+    filters such as [('fips', '==', 6037)] only read the matching partitions.
+    The partition column is dropped so the split has the same columns as scaled_zillow_columns'
+    '''
+    path = os.path.join(output_dir, f'split={split}')
+    #the partition key is only in the directory names, parquet adds it back as a categorical
+    partition_columns = {name.split('=')[0] for name in os.listdir(path) if '=' in name}
+    df = pd.read_parquet(path, filters = filters)
+    return df.drop(columns = [c for c in df.columns if c in partition_columns])
+
+
 ################################# Null Finder Functions #################################
 
+#number of set bits in every byte value
+bit_counts = np.unpackbits(np.arange(256, dtype = np.uint8)[:, None], axis = 1).sum(axis = 1).astype(np.uint8)
+
+
+def null_mask(df):
+    '''
+    This function scans a DataFrame for nulls once and returns them
+    bit-packed, one row of bytes per row with one bit per column
+    '''
+    return np.packbits(df.isnull().to_numpy(), axis = 1)
+
+
+def profile_mask(mask, columns, profile = None):
+    '''
+    This function adds a null_mask to a null profile (a new one by default):
+    the number of rows, the nulls in each column
+    and how many rows have each number of nulls
+    '''
+    if profile is None:
+        profile = {'columns': list(columns),
+                   'rows': 0,
+                   'column_nulls': np.zeros(len(columns), dtype = np.int64),
+                   'row_nulls': np.zeros(len(columns) + 1, dtype = np.int64)}
+    profile['rows'] += len(mask)
+    profile['column_nulls'] += np.unpackbits(mask, axis = 1, count = len(columns)).sum(axis = 0, dtype = np.int64)
+    profile['row_nulls'] += np.bincount(bit_counts[mask].sum(axis = 1, dtype = np.int64), minlength = len(columns) + 1)
+    return profile
+
+
+def null_profile(chunks):
+    '''
+    This function builds one null profile from any iterable of DataFrames
+    with the same columns, scanning each chunk once
+    '''
+    profile = None
+    for chunk in chunks:
+        profile = profile_mask(null_mask(chunk), chunk.columns, profile)
+    return profile
+
+
+def stream_null_profile(filenames = None, batch_size = 100000):
+    '''
+    This function profiles the nulls of one or more parquet caches
+    (the zillow cache by default) batch_size rows at a time without loading them whole
+    '''
+    if filenames is None:
+        filenames = [zillow_cache_file]
+    return null_profile(iter_zillow_batches(filenames, batch_size))
+
+
+def missing_value_plan(profile, prop_required_column, prop_required_row):
+    '''
+    This function returns the columns handle_missing_values keeps
+    and the non-null values a row then needs to be kept
+    '''
+    #setting threshold for row, only accepts integer
+    thresh_row = int(round(prop_required_column*profile['rows'],0))
+    columns = [c for c, nulls in zip(profile['columns'], profile['column_nulls']) if profile['rows'] - nulls >= thresh_row]
+    #setting threshold for columns, only accepts integer
+    thresh_col = int(round(prop_required_row*len(columns),0))
+    return columns, thresh_col
+
+
 def null_finder_columns(df):
     '''
     This function takes in a DataFrame and list 
     information about the null values in the columns
     '''
-    #accepts a 'df' and creates a new one labeled 'nulls'  
-    #nulls index is the df's columns
-    nulls = pd.DataFrame(index = df.columns)
-    #sums up the null values in the dataframes columns
-    nulls['num_rows_missing'] = df.isnull().sum(axis = 0)
-    #finds the percentage of null values in the df's columns
-    nulls['pct_rows_missing'] = nulls.num_rows_missing / df.shape[0]
-    return nulls
-
+    return profile_columns(null_profile([df]))
 
 
 def null_finder_rows(df):
@@ -185,22 +782,29 @@ def null_finder_rows(df):
     the percent of columns missing in the row
     and the number of rows that have the same amount of columns missing
     '''
-    #initiate a dataframe
-    rows = pd.DataFrame()
-    #find the number of columns missing in the row
-    rows['num_cols_missing'] = df.isnull().sum(axis=1)
-    #find the percentage of columns missing in the row
-    rows['pct_cols_missing'] = df.isnull().sum(axis=1) / df.shape[1]
-    #group by 'num_cols_missing' and find 
-    #how many rows have that number of columns missing
-    num_rows = rows.groupby('num_cols_missing').count()
-    #rename the column as 'num_rows'
-    num_rows = num_rows.rename(columns ={'pct_cols_missing': "num_rows"})
-    #group by 'num_cols_missing' and find 
-    #the percentage of columns missing in the row
-    pct_cols = rows.groupby('num_cols_missing').mean()
-    #combine the 'pct_cols' and 'num_rows'
-    result = pd.concat([pct_cols, num_rows], axis=1, sort=False)
-    #take the 'num_cols_missing' out of the index
-    result = result.reset_index()
-    return result
\ No newline at end of file
+    return profile_rows(null_profile([df]))
+
+
+def profile_columns(profile):
+    '''
+    This function lists the nulls in each column of a null profile
+    like null_finder_columns
+    '''
+    #nulls index is the df's columns
+    nulls = pd.DataFrame(index = pd.Index(profile['columns']))
+    nulls['num_rows_missing'] = profile['column_nulls']
+    #finds the percentage of null values in the df's columns
+    nulls['pct_rows_missing'] = nulls.num_rows_missing / profile['rows']
+    return nulls
+
+
+def profile_rows(profile):
+    '''
+    This function lists how many rows of a null profile have each number
+    of columns missing like null_finder_rows
+    '''
+    #only the numbers of missing columns some row has
+    num_cols_missing = np.flatnonzero(profile['row_nulls'])
+    return pd.DataFrame({'num_cols_missing': num_cols_missing,
+                         'pct_cols_missing': num_cols_missing / len(profile['columns']),
+                         'num_rows': profile['row_nulls'][num_cols_missing]})
@@ -0,0 +1,53 @@
+#the zillow feature definitions and artifact names shared by wrangle_zillow, explore and score,
+#plain python only so scoring never needs pandas or sklearn
+
+
+################################# Cleaning Settings #################################
+
+#values fill_nulls gives missing counts, and a missing heating system
+null_fill_values = {'poolcnt': 0, 'fireplacecnt': 0, 'unitcnt': 1}
+heating_fill_value = 'None'
+#remove_outliers keeps low < value <= high bedrooms and bathrooms, and low < value < high square feet
+bedroom_bounds = (0, 7)
+bathroom_bounds = (0, 7)
+square_feet_bounds = (400, 7000)
+#heating systems too rare to keep
+heating_outliers = ['Yes', 'Gravity', 'Radiant', 'Baseboard', 'Solar', 'Forced air']
+#create_features' outlier limits on the new features
+max_acres = 10
+max_taxrate = .05
+
+
+################################# Feature Definitions #################################
+
+#new feature constants
+feature_year = 2017
+square_feet_per_acre = 43560
+
+#names create_features gives the fips codes and heating systems, they become dummy columns
+county_names = {6037: 'los_angeles', 6059: 'orange', 6111: 'ventura'}
+heating_names = {'Central': 'central_heating', 'Floor/Wall': 'floor_wall_heating', 'None': 'no_heating'}
+#each dummy column and the raw value it flags
+county_dummies = {name: fips for fips, name in county_names.items()}
+heating_dummies = {name: heating for heating, name in heating_names.items()}
+
+#create_features' new features in the order they are made, each one computed from get(column),
+#which can return a pandas Series or a numpy array
+new_features = {
+    'age': lambda get: feature_year - get('yearbuilt'),
+    'taxrate': lambda get: get('taxamount') / get('taxvaluedollarcnt'),
+    'acres': lambda get: get('lotsizesquarefeet') / square_feet_per_acre,
+    'structure_dollar_per_sqft': lambda get: get('structuretaxvaluedollarcnt') / get('calculatedfinishedsquarefeet'),
+    'land_dollar_per_sqft': lambda get: get('landtaxvaluedollarcnt') / get('lotsizesquarefeet'),
+    'bed_bath_ratio': lambda get: get('bedroomcnt') / get('bathroomcnt'),
+}
+
+
+################################# Artifact Names #################################
+
+#file name every saved scaler is written under, scaled_zillow_columns saves its scaler here
+scaler_artifact_file = 'zillow_scaler.json'
+#where explore's cluster store saves its models
+cluster_model_dir = 'cluster_models'
+#file name of a saved cluster or scoring model inside its directory
+model_artifact_file = 'model.json'